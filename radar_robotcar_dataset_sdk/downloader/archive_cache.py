@@ -0,0 +1,207 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from contextlib import contextmanager
+import hashlib
+import shutil
+import fcntl
+import json
+import time
+import os
+
+from radar_robotcar_dataset_sdk.downloader.download_item import download_item_filename
+from radar_robotcar_dataset_sdk.downloader.zip_extractor import ExtractionStats, timestamps_members
+
+# Shared cache of unpacked archives, so download folders (e.g. of several users on one cluster) that want the same
+# dataset / sensor share one copy of it and one transfer from Google Drive
+# Each archive is unpacked once into the cache and its files are hardlinked (copied across file systems) into every
+# download folder. Entries are keyed by the archive name, size and MD5 so a re-uploaded archive gets a new entry,
+# and the least recently used entries are evicted once the cache is over its size limit. Evicting an entry never
+# breaks download folders as their hardlinks keep the data
+
+_entries_dir_name = "entries"
+_locks_dir_name = "locks"
+_entry_info_name = "entry.json"
+_entry_tree_name = "tree"
+_evict_lock_name = ".evict.lock"
+
+
+@contextmanager
+def _file_lock(path, mode=fcntl.LOCK_EX):
+    # Advisory lock shared between processes and hosts (on file systems supporting flock)
+    with open(path, 'a') as f:
+        fcntl.flock(f, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _try_file_lock(path):
+    # Yields False at once instead of waiting if the lock is held
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _tree_size(tree_dir):
+    num_files, num_bytes = 0, 0
+    for root, _, filenames in os.walk(tree_dir):
+        for filename in filenames:
+            num_files += 1
+            num_bytes += os.path.getsize(os.path.join(root, filename))
+    return num_files, num_bytes
+
+
+class ArchiveCache:
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size  # Bytes, None is unbounded
+        self.entries_dir = os.path.join(cache_dir, _entries_dir_name)
+        self.locks_dir = os.path.join(cache_dir, _locks_dir_name)
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+    def entry_name(self, downld, metadata=None):
+        # Without a remote listing the scraped size is all there is to tell versions of an archive apart
+        filename = download_item_filename(downld)
+        if metadata is not None:
+            identity = f"{filename}:{metadata.size}:{metadata.md5}"
+        else:
+            identity = f"{filename}:{downld.size}"
+        return f"{filename}-{hashlib.sha1(identity.encode()).hexdigest()[:16]}"
+
+    def _entry_dir(self, entry_name):
+        return os.path.join(self.entries_dir, entry_name)
+
+    def _lock_path(self, entry_name):
+        return os.path.join(self.locks_dir, entry_name + ".lock")
+
+    def contains(self, downld, metadata=None):
+        return os.path.isfile(os.path.join(self._entry_dir(self.entry_name(downld, metadata)), _entry_info_name))
+
+    @contextmanager
+    def populating(self, downld, metadata=None):
+        # Yields a folder to unpack the archive into, or None if the entry already exists (e.g. another run filled it
+        # while this one was downloading). The entry is only added once the block completes
+        entry_name = self.entry_name(downld, metadata)
+        entry_dir = self._entry_dir(entry_name)
+        with _file_lock(self._lock_path(entry_name)):
+            if os.path.isfile(os.path.join(entry_dir, _entry_info_name)):
+                yield None
+                return
+            tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            if os.path.isdir(entry_dir):
+                # Left behind by an interrupted run
+                shutil.rmtree(entry_dir)
+            os.makedirs(os.path.join(tmp_dir, _entry_tree_name))
+            try:
+                yield os.path.join(tmp_dir, _entry_tree_name)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            num_files, num_bytes = _tree_size(os.path.join(tmp_dir, _entry_tree_name))
+            with open(os.path.join(tmp_dir, _entry_info_name), 'w') as f:
+                json.dump({'dataset': downld.dataset, 'sensor': downld.sensor,
+                           'size': metadata.size if metadata is not None else downld.size,
+                           'md5': metadata.md5 if metadata is not None else None,
+                           'files': num_files, 'bytes': num_bytes, 'created_at': time.time()}, f)
+            os.replace(tmp_dir, entry_dir)
+
+    def link(self, downld, metadata, download_folder):
+        # Hardlinks the entry's files into download_folder, returns their ExtractionStats or None if the entry is not
+        # in the cache (e.g. another run evicted it since it was checked)
+        start_time = time.time()
+        entry_name = self.entry_name(downld, metadata)
+        entry_dir = self._entry_dir(entry_name)
+        tree_dir = os.path.join(entry_dir, _entry_tree_name)
+        num_files, num_bytes = 0, 0
+        member_names = []
+        # Shared so eviction cannot remove the entry half way through
+        with _file_lock(self._lock_path(entry_name), fcntl.LOCK_SH):
+            if not os.path.isfile(os.path.join(entry_dir, _entry_info_name)):
+                return None
+            for root, _, filenames in os.walk(tree_dir):
+                output_root = os.path.join(download_folder, os.path.relpath(root, tree_dir))
+                os.makedirs(output_root, exist_ok=True)
+                for filename in filenames:
+                    source = os.path.join(root, filename)
+                    member_names.append(os.path.relpath(source, tree_dir).replace(os.path.sep, '/'))
+                    destination = os.path.join(output_root, filename)
+                    if os.path.lexists(destination):
+                        if os.path.samefile(source, destination):
+                            continue
+                        os.remove(destination)
+                    try:
+                        os.link(source, destination)
+                    except OSError:
+                        # Different file system, or hardlinks to other users' files not permitted
+                        shutil.copy2(source, destination)
+                    num_files += 1
+                    num_bytes += os.path.getsize(destination)
+            # The entry's mtime is its last use for eviction
+            os.utime(os.path.join(entry_dir, _entry_info_name))
+        self.evict()
+        return ExtractionStats(num_files, num_bytes, time.time() - start_time, timestamps_members(member_names))
+
+    def _sweep(self):
+        # Removes the temporary folders of runs that crashed while filling or evicting an entry, a folder whose entry
+        # lock is free is not in use by any run
+        for name in os.listdir(self.entries_dir):
+            if not name.endswith((".tmp", ".evicted")):
+                continue
+            entry_name = name.rsplit('.', 2)[0]
+            with _try_file_lock(self._lock_path(entry_name)) as locked:
+                if locked:
+                    print(f"Removing {name} left behind in the archive cache")
+                    shutil.rmtree(os.path.join(self.entries_dir, name), ignore_errors=True)
+
+    def evict(self):
+        with _file_lock(os.path.join(self.cache_dir, _evict_lock_name)):
+            self._sweep()
+            if self.max_size is None:
+                return
+            entries = []
+            for entry_name in os.listdir(self.entries_dir):
+                info_path = os.path.join(self._entry_dir(entry_name), _entry_info_name)
+                if not os.path.isfile(info_path):
+                    continue
+                with open(info_path) as f:
+                    entry_bytes = json.load(f)['bytes']
+                entries.append((os.path.getmtime(info_path), entry_name, entry_bytes))
+            total_size = sum(entry_bytes for _, _, entry_bytes in entries)
+            for _, entry_name, entry_bytes in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                with _try_file_lock(self._lock_path(entry_name)) as locked:
+                    if not locked:
+                        # Being filled or linked right now
+                        continue
+                    print(f"Evicting {entry_name} ({entry_bytes / 1024 ** 3:.2f} GB) from the archive cache")
+                    # Renamed first so a half deleted entry is never mistaken for a complete one
+                    evicted_dir = f"{self._entry_dir(entry_name)}.{os.getpid()}.evicted"
+                    os.replace(self._entry_dir(entry_name), evicted_dir)
+                    shutil.rmtree(evicted_dir)
+                    total_size -= entry_bytes
@@ -0,0 +1,414 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from absl import app, flags
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+from collections import OrderedDict
+import threading
+import hashlib
+import zipfile
+import random
+import shutil
+import json
+import time
+import sys
+import os
+
+from radar_robotcar_dataset_sdk.downloader.download_item import DownloadItem, download_item_filename
+from radar_robotcar_dataset_sdk.downloader.gdrive_handler import GDriveHandler, _rclone_version, _rclone_binary_name
+from radar_robotcar_dataset_sdk.downloader.download_scheduler import DownloadScheduler
+from radar_robotcar_dataset_sdk.downloader.zip_extractor import extract_zip, extract_zip_stream
+from radar_robotcar_dataset_sdk.downloader.instrumentation import EventLog
+from radar_robotcar_dataset_sdk.downloader.catalogue import Catalogue
+
+# Offline benchmark of the downloader: a local stand-in for the dataset website, a fake rclone serving generated
+# archives from a local folder, and the real scraper, scheduler and extraction code in between
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("benchmark_dir", os.path.join(os.path.expanduser("~"), ".cache", "radar_robotcar_dataset_sdk",
+                                                  "benchmark"),
+                    "Working folder for the synthetic archives, fake rclone and downloads")
+flags.DEFINE_integer("benchmark_datasets", 3, "Number of synthetic datasets on the local website")
+flags.DEFINE_float("benchmark_archive_size_MB", 32., "Size of each synthetic camera / radar archive")
+flags.DEFINE_integer("benchmark_archive_members", 256, "Number of image files in each synthetic camera / radar "
+                                                       "archive")
+flags.DEFINE_float("benchmark_http_latency_ms", 50., "Latency added to every request to the local website")
+flags.DEFINE_float("benchmark_rclone_latency", 1., "Seconds added to every fake rclone invocation to model process "
+                                                   "start up, Drive listing and token refresh")
+flags.DEFINE_float("benchmark_bandwidth_MB", 50., "Bandwidth of each fake rclone transfer in MB/s (0 is unlimited)")
+flags.DEFINE_integer("benchmark_repeats", 3, "Number of times each scrape is repeated")
+flags.DEFINE_list("benchmark_parallel_downloads", ["1", "4"], "--parallel_downloads values to benchmark")
+flags.DEFINE_list("benchmark_batch_downloads", ["1"], "--batch_downloads values to benchmark")
+flags.DEFINE_list("benchmark_extract_processes", ["1", "4"], "--extract_processes values to benchmark")
+flags.DEFINE_bool("benchmark_stream_extract", False, "Benchmark downloads with --stream_extract")
+flags.DEFINE_string("benchmark_results", None, "Also write the results to this JSON file")
+
+_ls = "=" * 100  # Logging separator
+_site_path = "/radar-robotcar-dataset"
+_first_dataset_time = datetime(2019, 1, 10, 11, 46, 21)
+_spec_name = ".benchmark_spec.json"
+_fake_rclone_config_name = "fake_rclone.json"
+
+# Sensor name -> (folder, timestamps file, frame period in microseconds), None for the GPS / INS csv files
+_sensor_layouts = OrderedDict([
+    ("Navtech CTS350-X Radar", ("radar", "radar.timestamps", 250000)),
+    ("Point Grey Bumblebee XB3", ("stereo/centre", "stereo.timestamps", 62500)),
+    ("NovAtel GPS / INS", None),
+])
+
+_fake_rclone_script = '''#!{python}
+# Offline stand-in for rclone written by radar_robotcar_dataset_sdk.downloader.benchmark
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import time
+import sys
+import os
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "{config_name}")) as f:
+    config = json.load(f)
+value_options = ("--config", "--transfers", "--checkers", "--drive-chunk-size", "--files-from", "--offset", "--count",
+                 "--stats", "--stats-log-level")
+
+
+def remote_path(path):
+    return os.path.join(config["remote_dir"], path.split(":", 1)[-1])
+
+
+def throttled_copy(source, destination, count=-1):
+    # Every transfer is capped at the benchmark bandwidth like a single Drive connection
+    bandwidth = config["bandwidth_MB"] * 1024 ** 2
+    start_time = time.time()
+    copied = 0
+    while count < 0 or copied < count:
+        chunk = source.read(1024 * 1024 if count < 0 else min(1024 * 1024, count - copied))
+        if len(chunk) == 0:
+            break
+        destination.write(chunk)
+        copied += len(chunk)
+        if bandwidth > 0:
+            time.sleep(max(0., copied / bandwidth - (time.time() - start_time)))
+    return copied
+
+
+def copy_file(name, download_dir):
+    with open(remote_path(name), "rb") as source, open(os.path.join(download_dir, name), "wb") as destination:
+        return throttled_copy(source, destination)
+
+
+args = sys.argv[1:]
+if args == ["--version"]:
+    print("rclone {version}")
+    sys.exit(0)
+options = {{}}
+positional = []
+i = 0
+while i < len(args):
+    if args[i] in value_options:
+        options[args[i]] = args[i + 1]
+        i += 2
+    elif args[i].startswith("--"):
+        options[args[i]] = True
+        i += 1
+    else:
+        positional.append(args[i])
+        i += 1
+time.sleep(config["latency"])
+
+command = positional[0]
+if command == "about":
+    sys.exit(0)
+elif command == "lsjson":
+    listing = []
+    for name in sorted(os.listdir(config["remote_dir"])):
+        path = os.path.join(config["remote_dir"], name)
+        if name.startswith("."):
+            continue
+        with open(path, "rb") as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        listing.append({{"Path": name, "Name": name, "Size": os.path.getsize(path), "IsDir": False,
+                        "ModTime": "2019-12-01T00:00:00Z", "Hashes": {{"MD5": md5}}}})
+    print(json.dumps(listing))
+elif command == "copy":
+    start_time = time.time()
+    if "--files-from" in options:
+        with open(options["--files-from"]) as f:
+            names = [line.strip() for line in f if len(line.strip()) > 0]
+    else:
+        names = [positional[1].split(":", 1)[1]]
+    with ThreadPoolExecutor(max_workers=int(options.get("--transfers", 4))) as executor:
+        copied = sum(executor.map(lambda name: copy_file(name, positional[2]), names))
+    if "--use-json-log" in options:
+        elapsed = max(time.time() - start_time, 1e-6)
+        stats = {{"bytes": copied, "totalBytes": copied, "speed": copied / elapsed, "transfers": len(names),
+                 "errors": 0, "elapsedTime": elapsed}}
+        sys.stderr.write(json.dumps({{"level": "notice", "msg": "stats", "stats": stats}}) + "\\n")
+elif command == "cat":
+    with open(remote_path(positional[1]), "rb") as source:
+        source.seek(int(options.get("--offset", 0)))
+        throttled_copy(source, sys.stdout.buffer, int(options.get("--count", -1)))
+else:
+    sys.stderr.write("fake rclone: unsupported command: " + command + "\\n")
+    sys.exit(1)
+'''
+
+
+def synthetic_datasets(num_datasets):
+    # Named like the real traversals so date filters and dataset_datetime work on them
+    return [(_first_dataset_time + timedelta(days=i, hours=i)).strftime("%Y-%m-%d-%H-%M-%S") + "-radar-oxford-10k"
+            for i in range(num_datasets)]
+
+
+def _write_archive(path, dataset, sensor, archive_size, num_members, rng):
+    dataset_time = datetime.strptime(dataset[:19], "%Y-%m-%d-%H-%M-%S")
+    start_timestamp = int((dataset_time - datetime(1970, 1, 1)).total_seconds() * 1e6)
+    with zipfile.ZipFile(path + ".tmp", 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        layout = _sensor_layouts[sensor]
+        if layout is None:
+            # Text csv files compress well, like the real GPS / INS logs
+            for name, rows in (("gps.csv", archive_size // 512), ("ins.csv", archive_size // 128)):
+                lines = ["timestamp,latitude,longitude,altitude"]
+                lines += [f"{start_timestamp + 20000 * row},{51.76 + rng.random() / 100:.9f},"
+                          f"{-1.26 + rng.random() / 100:.9f},{110 + rng.random():.4f}" for row in range(rows)]
+                zip_file.writestr(f"{dataset}/gps/{name}", "\n".join(lines) + "\n")
+        else:
+            folder, timestamps_name, period = layout
+            timestamps = [start_timestamp + period * member for member in range(num_members)]
+            zip_file.writestr(f"{dataset}/{timestamps_name}", "".join(f"{t} 1\n" for t in timestamps))
+            # Images are already compressed so random bytes deflate about as badly as the real PNGs
+            member_size = archive_size // num_members
+            for timestamp in timestamps:
+                zip_file.writestr(f"{dataset}/{folder}/{timestamp}.png", rng.randbytes(member_size))
+    os.replace(path + ".tmp", path)
+
+
+def generate_archives(remote_dir, datasets, archive_size_MB, archive_members):
+    # Archives are kept between runs and only regenerated when their spec changes
+    spec = {'datasets': datasets, 'archive_size_MB': archive_size_MB, 'archive_members': archive_members}
+    spec_path = os.path.join(remote_dir, _spec_name)
+    downloads = [DownloadItem(dataset, sensor, "", "") for dataset in datasets for sensor in _sensor_layouts]
+    paths = [os.path.join(remote_dir, download_item_filename(downld)) for downld in downloads]
+    if os.path.isfile(spec_path) and all(os.path.isfile(path) for path in paths):
+        with open(spec_path) as f:
+            if json.load(f) == spec:
+                return OrderedDict(zip(downloads, paths))
+
+    print(f"Generating {len(downloads)} synthetic archives in: {remote_dir}")
+    if os.path.isdir(remote_dir):
+        shutil.rmtree(remote_dir)
+    os.makedirs(remote_dir)
+    rng = random.Random(0)
+    for downld, path in zip(downloads, paths):
+        _write_archive(path, downld.dataset, downld.sensor, int(archive_size_MB * 1024 ** 2), archive_members, rng)
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+    return OrderedDict(zip(downloads, paths))
+
+
+def _size_str(num_bytes):
+    return f"{num_bytes / 1024 ** 2:.2f} MB"
+
+
+def _site_pages(archives):
+    # Same markup as the parts of the dataset website read by DatasetScraper
+    pages = {}
+    datasets = list(OrderedDict.fromkeys(downld.dataset for downld in archives))
+    pages[f"{_site_path}/datasets"] = "<table>" + "".join(
+        f'<tr href="{_site_path}/datasets/{dataset}"><td>{dataset}</td></tr>' for dataset in datasets) + "</table>"
+    for dataset in datasets:
+        rows = []
+        for downld, path in archives.items():
+            if downld.dataset != dataset:
+                continue
+            link = f"https://drive.google.com/file/d/{download_item_filename(downld)}"
+            size = os.path.getsize(path)
+            if _sensor_layouts[downld.sensor] is None:
+                size_lines = f"GPS Size: {_size_str(size / 5)}\nINS Size: {_size_str(size * 4 / 5)}"
+            else:
+                size_lines = f"Size: {_size_str(size)}\nFormat: png"
+            rows.append(f'<tr><td>{downld.sensor}\n{size_lines}\n<a href="{link}">Download</a></td></tr>')
+        pages[f"{_site_path}/datasets/{dataset}"] = "<table>" + "".join(rows) + "</table>"
+    pages[f"{_site_path}/downloads"] = '<div id="sample_datasets"><ul><li>Tiny (1.2 GB) ' \
+                                       '<a href="https://drive.google.com/file/d/tiny">Download</a></li></ul></div>'
+    pages[_site_path] = "<html>Oxford Radar RobotCar Dataset</html>"
+    return pages
+
+
+class _SiteRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        path = "/" + "/".join(part for part in self.path.split("?")[0].split("/") if len(part) > 0)
+        page = self.server.pages.get(path)
+        if page is None:
+            self.send_error(404)
+            return
+        # Pages support conditional requests like the real site
+        etag = f'"{hashlib.md5(page.encode()).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = page.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BenchmarkSite(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, pages, latency=0.):
+        super().__init__(('127.0.0.1', 0), _SiteRequestHandler)
+        self.pages = pages
+        self.latency = latency
+        self.url = f"http://127.0.0.1:{self.server_address[1]}{_site_path}"
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def install_fake_rclone(rclone_dir, remote_dir, latency=0., bandwidth_MB=0.):
+    # Reports the requested rclone version so GDriveHandler skips the install script
+    os.makedirs(rclone_dir, exist_ok=True)
+    with open(os.path.join(rclone_dir, _fake_rclone_config_name), 'w') as f:
+        json.dump({'remote_dir': os.path.abspath(remote_dir), 'latency': latency, 'bandwidth_MB': bandwidth_MB}, f)
+    rclone_path = os.path.join(rclone_dir, _rclone_binary_name)
+    with open(rclone_path, 'w') as f:
+        f.write(_fake_rclone_script.format(python=sys.executable, config_name=_fake_rclone_config_name,
+                                           version=_rclone_version))
+    os.chmod(rclone_path, 0o755)
+    return rclone_path
+
+
+def benchmark_scrape(site_url, catalogue_path, repeats):
+    results = OrderedDict([('full', []), ('revalidate', [])])
+    catalogue = Catalogue(catalogue_path)
+    for _ in range(repeats):
+        start_time = time.time()
+        catalogue.refresh(site_url, force=True)
+        results['full'].append(time.time() - start_time)
+        start_time = time.time()
+        catalogue.refresh(site_url)
+        results['revalidate'].append(time.time() - start_time)
+    return catalogue, results
+
+
+def benchmark_download(downloads, download_folder, rclone_dir, parallel_downloads, batch_downloads, stream_extract):
+    if os.path.isdir(download_folder):
+        shutil.rmtree(download_folder)
+    event_log = EventLog()
+    gdrive_handler = GDriveHandler(download_folder, rclone_dir=rclone_dir, event_log=event_log)
+    remote_metadata = gdrive_handler.get_remote_metadata()
+    scheduler = DownloadScheduler(gdrive_handler, download_folder, parallel_downloads=parallel_downloads,
+                                  extract_workers=parallel_downloads, extract_queue_depth=parallel_downloads,
+                                  stream_extract=stream_extract, batch_downloads=batch_downloads,
+                                  remote_metadata=remote_metadata, event_log=event_log)
+    start_time = time.time()
+    scheduler.run(downloads)
+    wall_time = time.time() - start_time
+    num_bytes = sum(remote_metadata[download_item_filename(downld)].size for downld in downloads)
+    shutil.rmtree(download_folder)
+    return OrderedDict([('files', len(downloads)), ('bytes', num_bytes), ('seconds', wall_time),
+                        ('stages', event_log.summary())])
+
+
+def benchmark_extraction(zip_path, output_dir, extract_processes):
+    results = OrderedDict()
+    for workers in extract_processes:
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        results[f"extract_processes={workers}"] = extract_zip(zip_path, output_dir, workers=workers)
+    shutil.rmtree(output_dir)
+    with open(zip_path, 'rb') as f:
+        results["stream"] = extract_zip_stream(f, output_dir)
+    shutil.rmtree(output_dir)
+    return results
+
+
+def _print_scrape(name, seconds):
+    print(f"{name:<48} : mean {sum(seconds) / len(seconds):.3f} s - min {min(seconds):.3f} s "
+          f"({len(seconds)} repeats)")
+
+
+def main(unused_args):
+    benchmark_dir = FLAGS.benchmark_dir
+    remote_dir = os.path.join(benchmark_dir, "remote")
+    rclone_dir = os.path.join(benchmark_dir, "rclone")
+    datasets = synthetic_datasets(FLAGS.benchmark_datasets)
+    archives = generate_archives(remote_dir, datasets, FLAGS.benchmark_archive_size_MB,
+                                 FLAGS.benchmark_archive_members)
+    install_fake_rclone(rclone_dir, remote_dir, FLAGS.benchmark_rclone_latency, FLAGS.benchmark_bandwidth_MB)
+    site = BenchmarkSite(_site_pages(archives), FLAGS.benchmark_http_latency_ms / 1000)
+
+    try:
+        print(f"\n{_ls}\nScrape benchmark: {site.url}\n{_ls}")
+        catalogue, scrape_results = benchmark_scrape(site.url, os.path.join(benchmark_dir, "catalogue.json"),
+                                                     FLAGS.benchmark_repeats)
+    finally:
+        site.close()
+    downloads = catalogue.query()
+
+    download_results = OrderedDict()
+    for parallel_downloads in FLAGS.benchmark_parallel_downloads:
+        for batch_downloads in FLAGS.benchmark_batch_downloads:
+            name = f"parallel_downloads={parallel_downloads} batch_downloads={batch_downloads}"
+            print(f"\n{_ls}\nDownload benchmark: {name}\n{_ls}")
+            download_results[name] = benchmark_download(downloads, os.path.join(benchmark_dir, "downloads"),
+                                                        rclone_dir, int(parallel_downloads), int(batch_downloads),
+                                                        FLAGS.benchmark_stream_extract)
+
+    largest_zip_path = max(archives.values(), key=os.path.getsize)
+    print(f"\n{_ls}\nExtraction benchmark: {largest_zip_path}\n{_ls}")
+    extraction_results = benchmark_extraction(largest_zip_path, os.path.join(benchmark_dir, "extracted"),
+                                              [int(workers) for workers in FLAGS.benchmark_extract_processes])
+
+    print(f"\n{_ls}\nBenchmark results\n{_ls}")
+    _print_scrape("scrape (full)", scrape_results['full'])
+    _print_scrape("scrape (revalidate)", scrape_results['revalidate'])
+    for name, result in download_results.items():
+        print(f"{'download ' + name:<48} : {result['files']} files, {result['bytes'] / 1024 ** 2:.1f} MB in "
+              f"{result['seconds']:.1f} s ({result['bytes'] / 1024 ** 2 / result['seconds']:.1f} MB/s, "
+              f"{result['files'] / result['seconds']:.2f} files/s)")
+    for name, stats in extraction_results.items():
+        print(f"{'extract ' + name:<48} : {stats}")
+
+    if FLAGS.benchmark_results is not None:
+        results = OrderedDict([
+            ('flags', OrderedDict((flag, FLAGS[flag].value) for flag in sorted(FLAGS)
+                                  if flag.startswith("benchmark_"))),
+            ('scrape', scrape_results),
+            ('download', download_results),
+            ('extract', OrderedDict((name, OrderedDict([('members', stats.members), ('bytes', stats.bytes),
+                                                        ('seconds', stats.seconds),
+                                                        ('MB_per_s', stats.MB_per_second)]))
+                                    for name, stats in extraction_results.items())),
+        ])
+        with open(FLAGS.benchmark_results, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f"\nResults written to: {FLAGS.benchmark_results}")
+
+
+if __name__ == '__main__':
+    app.run(main)
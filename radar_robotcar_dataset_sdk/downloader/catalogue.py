@@ -0,0 +1,159 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import time
+import os
+
+from radar_robotcar_dataset_sdk.downloader.download_item import DownloadItem, download_item_size_GB
+
+_catalogue_version = 3  # Bumped whenever scraped values change so stale indexes are re-scraped
+_default_catalogue_path = os.path.join(os.path.expanduser("~"), ".cache", "radar_robotcar_dataset_sdk",
+                                       "catalogue.json")
+_dataset_date_format = "%Y-%m-%d-%H-%M-%S"
+
+
+def dataset_datetime(dataset):
+    # Dataset names start with the traversal start time e.g. `2019-01-10-11-46-21-radar-oxford-10k`
+    return datetime.strptime(dataset[:19], _dataset_date_format)
+
+
+def parse_date(date_str, end_of_day=False):
+    # Accepts `2019-01-10` or the full dataset timestamp prefix `2019-01-10-11-46-21`
+    try:
+        return datetime.strptime(date_str, _dataset_date_format)
+    except ValueError:
+        pass
+    try:
+        date = datetime.strptime(date_str, "%Y-%m-%d")
+        # A bare date used as an upper bound should include the whole day
+        return date.replace(hour=23, minute=59, second=59) if end_of_day else date
+    except ValueError:
+        pass
+    raise ValueError(f"Could not parse date '{date_str}': expected YYYY-MM-DD or YYYY-MM-DD-HH-MM-SS")
+
+
+class Catalogue:
+    def __init__(self, path=None):
+        self.path = path if path is not None else _default_catalogue_path
+        # `validators` holds the ETag / Last-Modified of every scraped page, keyed by url
+        self.data = {'version': _catalogue_version, 'base_url': None, 'fetched_at': 0., 'validators': {},
+                     'sample_datasets': {}, 'datasets': {}}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('version') == _catalogue_version:
+                self.data = data
+
+    @property
+    def is_empty(self):
+        return len(self.data['datasets']) == 0
+
+    @property
+    def age_hours(self):
+        return (time.time() - self.data['fetched_at']) / 3600
+
+    @property
+    def datasets(self):
+        return list(self.data['datasets'].keys())
+
+    @property
+    def sensors(self):
+        # The sensor list is defined by the first dataset, as on the website
+        return list(self.data['datasets'][self.datasets[0]].keys()) if not self.is_empty else []
+
+    @property
+    def sample_datasets(self):
+        return self.data['sample_datasets']
+
+    def dataset_info(self, dataset):
+        return self.data['datasets'][dataset]
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Jobs sharing the cache folder each write their own temporary file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def needs_refresh(self, ttl_hours, base_url=None):
+        return self.is_empty or self.age_hours > ttl_hours or \
+            (base_url is not None and base_url != self.data['base_url'])
+
+    def refresh(self, base_url, force=False):
+        # Imported here so offline listing from the index never pays for the scraping dependencies
+        from radar_robotcar_dataset_sdk.downloader.radar_robotcar_dataset_scraper import DatasetScraper
+
+        print(f"Scraping dataset info from: {base_url}")
+        dataset_scraper = DatasetScraper(base_url)
+        # Every page is revalidated on its own, so e.g. a dataset page gaining a download link is picked up even if
+        # the dataset list is unchanged
+        reuse = not force and not self.is_empty and base_url == self.data['base_url']
+        old_validators = self.data['validators'] if reuse else {}
+        validators = {}
+        unchanged = []
+
+        def fetch(url):
+            # Returns None if the page is unchanged since the last scrape
+            response = dataset_scraper.get_page(url, old_validators.get(url))
+            if response.status_code == 304:
+                validators[url] = old_validators[url]
+                unchanged.append(url)
+                return None
+            validators[url] = {'etag': response.headers.get('ETag'),
+                               'last_modified': response.headers.get('Last-Modified')}
+            return response
+
+        def dataset_info(dataset):
+            response = fetch(f"{dataset_scraper.datesets_url}/{dataset}")
+            if response is None and dataset in self.data['datasets']:
+                return self.data['datasets'][dataset]
+            return dataset_scraper.get_dataset_info(dataset, response)
+
+        response = fetch(dataset_scraper.datesets_url)
+        datasets = self.datasets if response is None else dataset_scraper.get_dataset_list(response)
+        datasets = list(dict.fromkeys(datasets))
+        with ThreadPoolExecutor(max_workers=max(1, min(dataset_scraper.max_workers, len(datasets)))) as executor:
+            dataset_infos = list(executor.map(dataset_info, datasets))
+        response = fetch(dataset_scraper.downloads_url)
+        if response is not None or not reuse:
+            self.data['sample_datasets'] = dataset_scraper.get_sample_dataset_list(response)
+        self.data['datasets'] = dict(zip(datasets, dataset_infos))
+        print(f"Dataset catalogue pages unchanged since last scrape: {len(unchanged)} / {len(validators)}")
+        self.data['validators'] = validators
+        self.data['base_url'] = base_url
+        self.data['fetched_at'] = time.time()
+        self.save()
+
+    def query(self, datasets=None, sensors=None, date_from=None, date_to=None, min_size_GB=None, max_size_GB=None):
+        downloads = []
+        for dataset in (datasets if datasets is not None else self.datasets):
+            if date_from is not None and dataset_datetime(dataset) < date_from:
+                continue
+            if date_to is not None and dataset_datetime(dataset) > date_to:
+                continue
+            dataset_info = self.dataset_info(dataset)
+            for sensor in (sensors if sensors is not None else dataset_info.keys()):
+                info = dataset_info[sensor]
+                downld = DownloadItem(dataset, sensor, info['Size'], info['Download'])
+                if min_size_GB is not None and download_item_size_GB(downld) < min_size_GB:
+                    continue
+                if max_size_GB is not None and download_item_size_GB(downld) > max_size_GB:
+                    continue
+                downloads.append(downld)
+        return downloads
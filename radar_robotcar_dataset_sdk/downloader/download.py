@@ -14,13 +14,25 @@
 
 from __future__ import division, print_function, absolute_import
 from absl import app, logging, flags
-import click
-import zipfile
+import shutil
 import os
-from google_drive_downloader import GoogleDriveDownloader as gdd
 
-from radar_robotcar_dataset_sdk.downloader.radar_robotcar_dataset_scraper import DatasetScraper
+# Importing the scraper module only defines its flags, it loads requests and bs4 lazily
+import radar_robotcar_dataset_sdk.downloader.radar_robotcar_dataset_scraper  # noqa: F401
 from radar_robotcar_dataset_sdk.downloader.gdrive_handler import GDriveHandler
+from radar_robotcar_dataset_sdk.downloader.download_scheduler import DownloadScheduler
+from radar_robotcar_dataset_sdk.downloader.download_item import download_item_size_GB, download_item_filename, \
+    download_item_available
+from radar_robotcar_dataset_sdk.downloader.download_journal import DownloadJournal
+from radar_robotcar_dataset_sdk.downloader.download_shards import shard_downloads, shard_journal_name, \
+    write_shard_manifest, merge_shards, RUNNING, COMPLETE
+from radar_robotcar_dataset_sdk.downloader.catalogue import Catalogue, parse_date
+from radar_robotcar_dataset_sdk.downloader.instrumentation import EventLog
+from radar_robotcar_dataset_sdk.downloader.remote_zip_reader import make_member_filter
+from radar_robotcar_dataset_sdk.downloader.transfer_controller import TransferController
+from radar_robotcar_dataset_sdk.downloader.archive_cache import ArchiveCache
+from radar_robotcar_dataset_sdk.downloader.segmented_downloader import SegmentedDownloader, \
+    resolve_gdrive_download_url
 
 FLAGS = flags.FLAGS
 
@@ -32,35 +44,125 @@ flags.DEFINE_string("datasets", None, "Comma separated list of datasets to downl
 flags.DEFINE_string("sample_dataset", None, "Sample dataset to download (one of `Tiny|Small|Medium|Large`). "
                                             "If provided --datasets and --sensors are ignored.")
 flags.DEFINE_bool("verbose", False, "Verbosely print sensor information")
+flags.DEFINE_integer("parallel_downloads", 1, "Number of files to download (and unpack) concurrently")
+flags.DEFINE_bool("largest_first", False, "Download the largest files first so long transfers do not all land at "
+                                          "the end of the run")
+flags.DEFINE_integer("extract_workers", 1, "Number of downloaded zips to unpack concurrently while later files "
+                                           "are still downloading")
+flags.DEFINE_integer("extract_queue_depth", 1, "Maximum number of downloaded zips waiting to be unpacked. "
+                                               "Bounds the extra disk space used by the download pipeline")
+flags.DEFINE_integer("extract_processes", 1, "Number of processes used to unpack the members of each zip")
+flags.DEFINE_bool("stream_extract", False, "Unpack each zip as it streams from Google Drive instead of saving it to "
+                                           "--download_folder first. Needs almost no extra disk space")
+flags.DEFINE_integer("batch_downloads", 1, "Number of files handed to each rclone invocation. Batches let rclone "
+                                           "parallelise and reuse connections across files itself")
+flags.DEFINE_integer("rclone_transfers", None, "rclone --transfers: number of file transfers run in parallel by each "
+                                               "rclone invocation (rclone default 4)")
+flags.DEFINE_integer("rclone_checkers", None, "rclone --checkers: number of checkers run in parallel by each rclone "
+                                              "invocation (rclone default 8)")
+flags.DEFINE_string("rclone_drive_chunk_size", None, "rclone --drive-chunk-size e.g. `64M` (rclone default 8M)")
+flags.DEFINE_bool("journal", True, "Record the state of each download in a journal in --download_folder so an "
+                                   "interrupted run skips finished files and resumes downloaded zips when rerun")
+flags.DEFINE_string("rclone_dir", None, "Folder holding an rclone install and authorised config shared between "
+                                        "download folders (default --download_folder)")
+flags.DEFINE_bool("remote_metadata", True, "List the shared drive once with `rclone lsjson` to get exact file sizes "
+                                           "and hashes for disk space checks and download integrity checks")
+flags.DEFINE_bool("verify_md5", False, "Check the MD5 of every downloaded zip against Google Drive (needs "
+                                       "--remote_metadata and not --stream_extract)")
+flags.DEFINE_bool("check_free_space", True, "Refuse to start if --download_folder does not have enough free space")
+flags.DEFINE_integer("sample_segments", 8, "Number of byte ranges of a sample dataset downloaded in parallel. "
+                                           "Interrupted sample downloads resume. 0 uses a single unresumable stream")
+flags.DEFINE_integer("sample_segment_size_MB", 64, "Size of each sample dataset byte range")
+flags.DEFINE_string("events_log", None, "Append machine readable JSON-lines timing and throughput events (per stage "
+                                        "and per dataset / sensor, plus a run summary) to this file")
+flags.DEFINE_string("catalogue_path", None, "Path of the local dataset catalogue index "
+                                            "(default ~/.cache/radar_robotcar_dataset_sdk/catalogue.json)")
+flags.DEFINE_float("catalogue_ttl_hours", 24., "Age after which the catalogue index is refreshed from the website")
+flags.DEFINE_bool("refresh_catalogue", False, "Force a full re-scrape of the website into the catalogue index")
+flags.DEFINE_bool("offline", False, "Only use the local catalogue index, never contact the website")
+flags.DEFINE_string("date_from", None, "Only include datasets recorded on or after this date (YYYY-MM-DD)")
+flags.DEFINE_string("date_to", None, "Only include datasets recorded on or before this date (YYYY-MM-DD)")
+flags.DEFINE_float("min_size_GB", None, "Only include downloads of at least this size")
+flags.DEFINE_float("max_size_GB", None, "Only include downloads of at most this size")
+flags.DEFINE_list("member_glob", None, "Only extract archive members matching one of these comma separated globs "
+                                       "e.g. `*.timestamps`. Members are read from Google Drive with ranged reads so "
+                                       "the rest of each archive is never transferred")
+flags.DEFINE_integer("timestamp_from", None, "Only extract frames (members named by a UNIX timestamp in microseconds) "
+                                             "at or after this timestamp, with ranged reads as for --member_glob")
+flags.DEFINE_integer("timestamp_to", None, "Only extract frames at or before this timestamp, with ranged reads as for "
+                                           "--member_glob")
+flags.DEFINE_integer("member_workers", 4, "Number of concurrent ranged reads per archive with --member_glob or "
+                                          "--timestamp_from/to")
+flags.DEFINE_integer("max_attempts", 5, "Attempts per file before a network or rclone failure ends the run. Failed "
+                                        "files are retried later with jittered exponential backoff while the rest "
+                                        "carry on. Rate limits halve the number of concurrent transfers, which then "
+                                        "grows back as transfers succeed")
+flags.DEFINE_float("quota_retry_minutes", 60., "Wait before retrying a file that hit its Google Drive download quota, "
+                                               "the rest of the selection carries on meanwhile")
+flags.DEFINE_integer("max_quota_retries", 24, "Retries per file after Google Drive download quota failures before "
+                                              "the run fails")
+flags.DEFINE_string("cache_dir", None, "Shared archive cache. Each archive is unpacked once into the cache and "
+                                       "hardlinked from there into every --download_folder that wants it, so download "
+                                       "folders on one file system share the data and the transfer")
+flags.DEFINE_float("cache_max_size_GB", None, "Evict the least recently used archives once --cache_dir is larger "
+                                              "than this (None is unbounded)")
+flags.DEFINE_bool("pack_shards", False, "After downloading, pack the frames of each sensor this run downloaded (e.g. "
+                                        "`radar/*.png`) into large memory mappable shard files with a timestamp "
+                                        "index, so training reads a few large files rather than a file per frame. "
+                                        "Needs numpy (the `pack` extra) and the journal")
+flags.DEFINE_integer("pack_shard_size_MB", 1024, "Size of each packed shard file with --pack_shards")
+flags.DEFINE_integer("pack_workers", 4, "Number of sensors packed concurrently with --pack_shards")
+flags.DEFINE_bool("pack_remove_frames", False, "Delete the individual frame files once they are packed")
+flags.DEFINE_integer("num_shards", 1, "Split the selected downloads into this many size balanced shards, e.g. one per "
+                                      "host writing to the same shared --download_folder")
+flags.DEFINE_integer("shard_index", 0, "Shard of the selected downloads fetched by this run (0 to --num_shards - 1)")
+flags.DEFINE_bool("merge_shards", False, "Check every shard of the selection has finished into --download_folder "
+                                         "instead of downloading")
 
 
-def human_readable_size_to_GB(human_readable_size_str):
-    size, multiplier = human_readable_size_str.strip().split()
-    size = float(size)
-    multiplier = multiplier.upper()
-    if multiplier == "GB":
-        pass
-    elif multiplier == "MB":
-        size /= 1024
-    elif multiplier == "KB":
-        size /= 1024 ** 2
-    elif multiplier == "B":
-        size /= 1024 ** 3
-    return size
+def load_catalogue(event_log):
+    catalogue = Catalogue(FLAGS.catalogue_path)
+    if FLAGS.offline:
+        if catalogue.is_empty:
+            raise FileNotFoundError(f"--offline given but no catalogue index found at: {catalogue.path}")
+        print(f"Using offline dataset catalogue: {catalogue.path} ({catalogue.age_hours:.1f} hours old)")
+    elif FLAGS.refresh_catalogue or catalogue.needs_refresh(FLAGS.catalogue_ttl_hours, FLAGS.dataset_url):
+        with event_log.stage('scrape'):
+            catalogue.refresh(FLAGS.dataset_url, force=FLAGS.refresh_catalogue)
+    else:
+        print(f"Using dataset catalogue: {catalogue.path} ({catalogue.age_hours:.1f} hours old)")
+    return catalogue
+
+
+def required_disk_space(download_sizes):
+    # The sensor data is mostly already compressed so the unpacked data is about the size of the zips, on top of
+    # which the pipeline can hold a bounded number of downloaded zips on disk
+    if FLAGS.stream_extract:
+        zips_on_disk = 0
+    else:
+        zips_on_disk = FLAGS.parallel_downloads * FLAGS.batch_downloads + FLAGS.extract_queue_depth + \
+                       FLAGS.extract_workers
+    return sum(download_sizes) + sum(sorted(download_sizes, reverse=True)[:zips_on_disk])
 
 
 def main(unused_args):
+    event_log = EventLog(FLAGS.events_log)
+    try:
+        download(event_log)
+    finally:
+        event_log.summary()
+        event_log.close()
+
+
+def download(event_log):
     print("\nOxford Radar RobotCar Dataset Downloader")
     print("==========================================================")
 
     print("Any issues please contact: radarrobotcardataset@robots.ox.ac.uk")
-    print(f"Scraping dataset info from: {FLAGS.dataset_url}")
 
-    dataset_scraper = DatasetScraper()
-
-    sample_datasets = dataset_scraper.get_sample_dataset_list()
-    datasets_raw = dataset_scraper.get_dataset_list()
-    sensors_raw = list(dataset_scraper.get_dataset_info(datasets_raw[0]).keys())
+    catalogue = load_catalogue(event_log)
+    sample_datasets = catalogue.sample_datasets
+    datasets_raw = catalogue.datasets
 
     print("\nAvaiable Sample Datasets:")
     print("==========================================================")
@@ -79,6 +181,8 @@ def main(unused_args):
             print(f"Sample dataset to download: {FLAGS.sample_dataset}")
             print(f"Total download size (before unpacking): {sample_dataset_download['Size']}\n")
             if FLAGS.download_folder is not None:
+                import click
+
                 print("Are you sure you want to download the above files and unpack into:")
                 print(FLAGS.download_folder)
                 if not click.confirm("\nDo you wish to continue?", False):
@@ -90,8 +194,22 @@ def main(unused_args):
                 # The sample datasets are public so we do not use the authenticated GDrive
                 download_path = FLAGS.download_folder + \
                                 f"/oxford_radar_robotcar_dataset_sample_{FLAGS.sample_dataset.lower()}.zip"
-                gdd.download_file_from_google_drive(file_id, download_path, overwrite=True, unzip=True, showsize=True)
-                os.remove(download_path)
+                if FLAGS.sample_segments > 0:
+                    os.makedirs(FLAGS.download_folder, exist_ok=True)
+                    downloader = SegmentedDownloader(segments=FLAGS.sample_segments,
+                                                     segment_size=FLAGS.sample_segment_size_MB * 1024 ** 2)
+                    download_url = resolve_gdrive_download_url(downloader.session, file_id)
+                    # Unzips from the completed start of the file while later segments are still downloading
+                    extraction_stats = downloader.download(download_url, download_path,
+                                                           extract_dir=FLAGS.download_folder)
+                    print(f"Extracted: {extraction_stats}")
+                else:
+                    from google_drive_downloader import GoogleDriveDownloader as gdd
+
+                    gdd.download_file_from_google_drive(file_id, download_path, overwrite=True, unzip=True,
+                                                        showsize=True)
+                if os.path.isfile(download_path):
+                    os.remove(download_path)
                 print(f"\nDownload completed into: {FLAGS.download_folder}\n")
             else:
                 print("--download_folder is missing. Returning.")
@@ -118,6 +236,8 @@ def main(unused_args):
         print("\n".join(datasets))
         print("")
 
+    sensors_raw = catalogue.sensors
+
     print("\nAvaiable Sensors:")
     print("==========================================================")
     print("\n".join(sensors_raw))
@@ -141,23 +261,49 @@ def main(unused_args):
     print(f"\nFinding Matching Files...")
     print("==========================================================" * 4)
     print(f"{'Match No':8} : {'Dataset':48} - {'Sensor':50} - {'Download Size':17} - {'Download Link':100}")
-    downloads = []
-    total_size = 0.
-    for di, dataset in enumerate(datasets):
-        dataset_info = dataset_scraper.get_dataset_info(dataset)
-        dataset_info = {k: dataset_info[k] for k in sensors}
-        for si, (k, v) in enumerate(dataset_info.items()):
-            downloads.append([dataset, k, v['Size'], v['Download']])
-            if len(v['Size']) > 0:
-                total_size += human_readable_size_to_GB(v['Size'])
-            print(f"{len(downloads):>8} : {dataset:48} - {k:50} - {v['Size']:17} - {v['Download']:100}")
-            if FLAGS.verbose:
-                print(f"{'Verbose':>8} : {v}")
-        print("")
+    downloads = catalogue.query(datasets, sensors,
+                                date_from=parse_date(FLAGS.date_from) if FLAGS.date_from else None,
+                                date_to=parse_date(FLAGS.date_to, end_of_day=True) if FLAGS.date_to else None,
+                                min_size_GB=FLAGS.min_size_GB, max_size_GB=FLAGS.max_size_GB)
+    total_size = sum(download_item_size_GB(downld) for downld in downloads)
+    for di, downld in enumerate(downloads):
+        print(f"{di + 1:>8} : {downld.dataset:48} - {downld.sensor:50} - {downld.size:17} - {downld.link:100}")
+        if FLAGS.verbose:
+            print(f"{'Verbose':>8} : {catalogue.dataset_info(downld.dataset)[downld.sensor]}")
+        if di + 1 == len(downloads) or downloads[di + 1].dataset != downld.dataset:
+            print("")
+
+    print(f"Number of files to download: {len(downloads)}")
+    print(f"Total download size (before unpacking): {total_size:.2f} GB\n")
+
+    selection = downloads
+    if FLAGS.merge_shards:
+        if FLAGS.download_folder is None:
+            print("--download_folder is missing. Returning.")
+            return
+        problems = merge_shards(FLAGS.download_folder, selection, FLAGS.num_shards)
+        for problem in problems:
+            print(f"Missing: {problem}")
+        if len(problems) > 0:
+            raise RuntimeError(f"{len(problems)} problems merging {FLAGS.num_shards} shards in: "
+                               f"{FLAGS.download_folder}")
+        print(f"All {FLAGS.num_shards} shards complete: {len(selection)} files in {FLAGS.download_folder}\n")
+        return
+    if not 0 <= FLAGS.shard_index < FLAGS.num_shards:
+        raise ValueError(f"--shard_index must be in [0, {FLAGS.num_shards}): {FLAGS.shard_index}")
+    if FLAGS.num_shards > 1:
+        shards = shard_downloads(selection, FLAGS.num_shards)
+        downloads = shards[FLAGS.shard_index]
+        for shard_index, shard in enumerate(shards):
+            shard_size = sum(download_item_size_GB(downld) for downld in shard)
+            print(f"Shard {shard_index:4} / {FLAGS.num_shards:4} : {len(shard):4} files, {shard_size:.2f} GB"
+                  f"{' <- this run' if shard_index == FLAGS.shard_index else ''}")
+        print(f"\nNumber of files to download in shard {FLAGS.shard_index}: {len(downloads)}")
+        print(f"Shard download size (before unpacking): "
+              f"{sum(download_item_size_GB(downld) for downld in downloads):.2f} GB\n")
 
     if FLAGS.download_folder is not None:
-        print(f"Number of files to download: {len(downloads)}")
-        print(f"Total download size (before unpacking): {total_size:.2f} GB\n")
+        import click
 
         print("Are you sure you want to download the above files and unpack into:")
         print(FLAGS.download_folder)
@@ -166,24 +312,101 @@ def main(unused_args):
             return
 
         print("")
-        gdrive_handler = GDriveHandler(FLAGS.download_folder)
-        for di, downld in enumerate(downloads):
-            print(
-                f"\nDownloading {di:4} / {len(downloads):4} : {downld[0]:48} - {downld[1]:25} - {downld[2]:17} - "
-                f"{downld[3]:100}\n")
-            if "available soon" in downld[3].lower():
-                print(f"Sorry this download isn't available yet, but it will be soon. Skipping...")
-            else:
-                # fileId = os.path.basename(downld[3])
-                # rclone doesn't support downloading via fileId so we generate the filename
-                filename = "_".join([downld[0], downld[1].replace(' ', '_').replace('/', '--')])
-                downloaded_zip_file_path = gdrive_handler.download_filename(filename)
-
-                print(f"\nExtracting into: {FLAGS.download_folder} ...")
-                downloaded_zip_file = zipfile.ZipFile(downloaded_zip_file_path, allowZip64=True)
-                downloaded_zip_file.extractall(FLAGS.download_folder)
-                print(f"Deleting Zip File {downloaded_zip_file_path} ...")
-                os.remove(downloaded_zip_file_path)
+        gdrive_handler = GDriveHandler(FLAGS.download_folder, transfers=FLAGS.rclone_transfers,
+                                       checkers=FLAGS.rclone_checkers, drive_chunk_size=FLAGS.rclone_drive_chunk_size,
+                                       rclone_dir=FLAGS.rclone_dir, event_log=event_log)
+
+        remote_metadata = None
+        download_sizes = {download_item_filename(downld): download_item_size_GB(downld) * 1024 ** 3
+                          for downld in downloads if download_item_available(downld)}
+        if FLAGS.remote_metadata:
+            print("Listing Google Drive for exact file sizes and hashes...")
+            with event_log.stage('remote_metadata'):
+                remote_metadata = gdrive_handler.get_remote_metadata()
+            missing = [download_item_filename(downld) for downld in downloads if download_item_available(downld) and
+                       download_item_filename(downld) not in remote_metadata]
+            for filename in missing:
+                print(f"Warning: {filename} not found in the Google Drive listing")
+            download_sizes = {filename: remote_metadata[filename].size for filename in download_sizes
+                              if filename in remote_metadata}
+            print(f"Exact download size (before unpacking): {sum(download_sizes.values()) / 1024 ** 3:.3f} GB "
+                  f"({sum(download_sizes.values())} bytes)")
+
+        member_filter = None
+        if FLAGS.member_glob is not None or FLAGS.timestamp_from is not None or FLAGS.timestamp_to is not None:
+            member_filter = make_member_filter(FLAGS.member_glob, FLAGS.timestamp_from, FLAGS.timestamp_to)
+
+        archive_cache = None
+        if FLAGS.cache_dir is not None and member_filter is None:
+            # Partial extractions bypass the cache as they do not unpack whole archives
+            archive_cache = ArchiveCache(FLAGS.cache_dir, FLAGS.cache_max_size_GB * 1024 ** 3
+                                         if FLAGS.cache_max_size_GB is not None else None)
+        journal = None
+        if FLAGS.journal and member_filter is None:
+            # Partial extractions are not journalled, and shards sharing a download folder each keep their own journal
+            journal = DownloadJournal(FLAGS.download_folder,
+                                      shard_journal_name(FLAGS.shard_index, FLAGS.num_shards)
+                                      if FLAGS.num_shards > 1 else None)
+        if FLAGS.check_free_space and member_filter is None:
+            # Items finished by an earlier run or already in the archive cache need no more space
+            pending_sizes = []
+            for downld in downloads:
+                filename = download_item_filename(downld)
+                if filename not in download_sizes or (journal is not None and journal.is_finished(downld)):
+                    continue
+                if archive_cache is not None and archive_cache.contains(
+                        downld, remote_metadata.get(filename) if remote_metadata is not None else None):
+                    continue
+                pending_sizes.append(download_sizes[filename])
+            required = required_disk_space(pending_sizes)
+            free = shutil.disk_usage(FLAGS.download_folder).free
+            print(f"Estimated disk space needed: {required / 1024 ** 3:.2f} GB, free: {free / 1024 ** 3:.2f} GB")
+            if required > free:
+                print(f"Not enough free space in {FLAGS.download_folder}. Free some space, download fewer files, "
+                      f"use --stream_extract or pass --nocheck_free_space to continue anyway.")
+                return
+
+        scheduler = DownloadScheduler(gdrive_handler, FLAGS.download_folder,
+                                      parallel_downloads=FLAGS.parallel_downloads,
+                                      largest_first=FLAGS.largest_first,
+                                      extract_workers=FLAGS.extract_workers,
+                                      extract_queue_depth=FLAGS.extract_queue_depth,
+                                      extract_processes=FLAGS.extract_processes,
+                                      stream_extract=FLAGS.stream_extract,
+                                      batch_downloads=FLAGS.batch_downloads,
+                                      journal=journal,
+                                      remote_metadata=remote_metadata,
+                                      verify_md5=FLAGS.verify_md5,
+                                      event_log=event_log,
+                                      member_filter=member_filter,
+                                      member_workers=FLAGS.member_workers,
+                                      archive_cache=archive_cache,
+                                      transfer_controller=TransferController(
+                                          FLAGS.parallel_downloads, max_attempts=FLAGS.max_attempts,
+                                          quota_retry_seconds=FLAGS.quota_retry_minutes * 60,
+                                          max_quota_retries=FLAGS.max_quota_retries, event_log=event_log))
+        if FLAGS.num_shards > 1:
+            write_shard_manifest(FLAGS.download_folder, FLAGS.shard_index, FLAGS.num_shards, selection, downloads,
+                                 RUNNING)
+        scheduler.run(downloads)
+        if FLAGS.num_shards > 1:
+            write_shard_manifest(FLAGS.download_folder, FLAGS.shard_index, FLAGS.num_shards, selection, downloads,
+                                 COMPLETE)
+
+        if FLAGS.pack_shards and journal is None:
+            print("\n--pack_shards needs the journal of whole archive downloads to know which sensor streams this run "
+                  "unpacked, skipping packing")
+        elif FLAGS.pack_shards:
+            from radar_robotcar_dataset_sdk.downloader.shard_packer import pack_streams
+
+            print(f"\nPacking frames into shards with {FLAGS.pack_workers} workers...")
+            # Only this run's own finished items, other shards sharing the folder may still be unpacking theirs
+            timestamps_names = [timestamps_name for downld in downloads if journal.is_finished(downld)
+                                for timestamps_name in journal.entry(downld).get('timestamps', [])]
+            with event_log.stage('pack_shards'):
+                pack_streams(FLAGS.download_folder, timestamps_names, workers=FLAGS.pack_workers,
+                             shard_size=FLAGS.pack_shard_size_MB * 1024 ** 2,
+                             remove_frames=FLAGS.pack_remove_frames, event_log=event_log)
 
         print(f"\nDownload completed into: {FLAGS.download_folder}\n")
 
@@ -0,0 +1,47 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from collections import namedtuple
+
+# Indexable like the [dataset, sensor, size, link] lists used by the downloader script
+DownloadItem = namedtuple('DownloadItem', ['dataset', 'sensor', 'size', 'link'])
+
+
+def human_readable_size_to_GB(human_readable_size_str):
+    size, multiplier = human_readable_size_str.strip().split()
+    size = float(size)
+    multiplier = multiplier.upper()
+    if multiplier == "GB":
+        pass
+    elif multiplier == "MB":
+        size /= 1024
+    elif multiplier == "KB":
+        size /= 1024 ** 2
+    elif multiplier == "B":
+        size /= 1024 ** 3
+    return size
+
+
+def download_item_size_GB(item):
+    return human_readable_size_to_GB(item.size) if len(item.size) > 0 else 0.
+
+
+def download_item_filename(item):
+    # rclone doesn't support downloading via fileId so we generate the filename
+    return "_".join([item.dataset, item.sensor.replace(' ', '_').replace('/', '--')])
+
+
+def download_item_available(item):
+    return "available soon" not in item.link.lower()
@@ -0,0 +1,124 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from collections import namedtuple
+from datetime import datetime
+import threading
+import queue
+import os
+
+from radar_robotcar_dataset_sdk.downloader.radar_robotcar_dataset_scraper import _default_dataset_url
+from radar_robotcar_dataset_sdk.downloader.download_item import download_item_available
+from radar_robotcar_dataset_sdk.downloader.gdrive_handler import GDriveHandler
+from radar_robotcar_dataset_sdk.downloader.download_scheduler import DownloadScheduler
+from radar_robotcar_dataset_sdk.downloader.download_journal import DownloadJournal
+from radar_robotcar_dataset_sdk.downloader.catalogue import Catalogue, parse_date
+
+# Library entry point: downloads run in a background thread and each (dataset, sensor) is yielded as soon as it is
+# unpacked, so e.g. training on the first traversal can start while the rest are still downloading
+#
+#   for ready in iter_downloads("/data/oxford-radar-robotcar-dataset", sensors=["Navtech CTS350-X Radar"]):
+#       print(ready.dataset, ready.sensor, ready.path)
+
+ReadyItem = namedtuple('ReadyItem', ['dataset', 'sensor', 'path'])
+
+_catalogue_ttl_hours = 24.
+_finished = object()  # Queue sentinel once the scheduler returns
+
+
+def _as_datetime(date, end_of_day=False):
+    if date is None or isinstance(date, datetime):
+        return date
+    return parse_date(date, end_of_day=end_of_day)
+
+
+def _ready_item(download_folder, downld):
+    # Archives unpack into a folder per dataset, shared by all of its sensors
+    return ReadyItem(downld.dataset, downld.sensor, os.path.join(download_folder, downld.dataset))
+
+
+def iter_downloads(download_folder, datasets=None, sensors=None, date_from=None, date_to=None, min_size_GB=None,
+                   max_size_GB=None, max_ready=1, catalogue=None, dataset_url=None, rclone_dir=None, journal=True,
+                   remote_metadata=True, **scheduler_args):
+    # Never prompts for confirmation (rclone still asks for Google Drive authorisation on first use)
+    # At most `max_ready` unpacked items wait for the consumer, after that the workers block until it catches up
+    # `scheduler_args` are passed to DownloadScheduler e.g. parallel_downloads, extract_workers, stream_extract
+    if max_ready < 1:
+        raise ValueError(f"max_ready must be at least 1: {max_ready}")
+    dataset_url = dataset_url if dataset_url is not None else _default_dataset_url
+    if catalogue is None:
+        catalogue = Catalogue()
+        if catalogue.needs_refresh(_catalogue_ttl_hours, dataset_url):
+            catalogue.refresh(dataset_url)
+    downloads = catalogue.query(datasets, sensors, _as_datetime(date_from), _as_datetime(date_to, end_of_day=True),
+                                min_size_GB, max_size_GB)
+    downloads = [downld for downld in downloads if download_item_available(downld)]
+
+    download_journal = DownloadJournal(download_folder) if journal else None
+    if download_journal is not None:
+        # Items finished by an earlier run are ready straight away
+        for downld in downloads:
+            if download_journal.is_finished(downld):
+                yield _ready_item(download_folder, downld)
+        downloads = [downld for downld in downloads if not download_journal.is_finished(downld)]
+    if len(downloads) == 0:
+        return
+
+    gdrive_handler = GDriveHandler(download_folder, rclone_dir=rclone_dir)
+    ready = queue.Queue(maxsize=max_ready)
+    closed = threading.Event()
+
+    def on_complete(downld):
+        # Blocks the calling worker while the consumer is behind, gives up once the consumer has gone
+        while not closed.is_set():
+            try:
+                ready.put(_ready_item(download_folder, downld), timeout=1.)
+                return
+            except queue.Full:
+                continue
+
+    scheduler = DownloadScheduler(gdrive_handler, download_folder, journal=download_journal,
+                                  remote_metadata=gdrive_handler.get_remote_metadata() if remote_metadata else None,
+                                  on_complete=on_complete, **scheduler_args)
+    errors = []
+
+    def run():
+        try:
+            scheduler.run(downloads)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            while not closed.is_set():
+                try:
+                    ready.put(_finished, timeout=1.)
+                    break
+                except queue.Full:
+                    continue
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is _finished:
+                break
+            yield item
+    finally:
+        # Also reached when the consumer stops iterating early, in-flight files are finished and the rest left
+        closed.set()
+        scheduler.stop()
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
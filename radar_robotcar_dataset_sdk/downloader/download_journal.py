@@ -0,0 +1,87 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+import threading
+import json
+import time
+import os
+
+from radar_robotcar_dataset_sdk.downloader.download_item import download_item_filename
+
+_journal_name = ".rrcd_download_journal.json"
+
+# Item states in the order they are reached
+PENDING = "pending"
+DOWNLOADED = "downloaded"
+EXTRACTED = "extracted"
+VERIFIED = "verified"
+_states = (PENDING, DOWNLOADED, EXTRACTED, VERIFIED)
+
+
+class DownloadJournal:
+    def __init__(self, download_folder, name=None):
+        # Runs sharing a download folder from several hosts need a journal each, see download_shards
+        self.path = os.path.join(download_folder, name if name is not None else _journal_name)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def state(self, downld):
+        entry = self.entries.get(download_item_filename(downld))
+        return entry['state'] if entry is not None else PENDING
+
+    def entry(self, downld):
+        return self.entries.get(download_item_filename(downld), {})
+
+    def is_finished(self, downld):
+        # An extraction is only finished once verified, EXTRACTED items are re-extracted from their zip
+        return self.state(downld) == VERIFIED
+
+    def downloaded_zip_file_path(self, downld):
+        # Only usable if the zip from an interrupted run is still on disk
+        if self.state(downld) not in (DOWNLOADED, EXTRACTED):
+            return None
+        path = self.entry(downld).get('zip_path')
+        return path if path is not None and os.path.isfile(path) else None
+
+    def add_pending(self, downloads):
+        with self._lock:
+            for downld in downloads:
+                key = download_item_filename(downld)
+                if key not in self.entries:
+                    self.entries[key] = {'dataset': downld.dataset, 'sensor': downld.sensor, 'state': PENDING,
+                                         'updated_at': time.time()}
+            self._save()
+
+    def set_state(self, downld, state, **info):
+        if state not in _states:
+            raise ValueError(f"Unknown journal state: {state}")
+        with self._lock:
+            entry = self.entries.setdefault(download_item_filename(downld),
+                                            {'dataset': downld.dataset, 'sensor': downld.sensor})
+            entry.update(info)
+            entry['state'] = state
+            entry['updated_at'] = time.time()
+            self._save()
+
+    def _save(self):
+        # Written via a rename so an interrupted run never leaves a truncated journal behind, and the temp file is per
+        # process so runs sharing a download folder never write into the same one
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
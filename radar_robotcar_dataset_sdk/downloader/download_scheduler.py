@@ -0,0 +1,460 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from contextlib import nullcontext
+from collections import OrderedDict
+import threading
+import hashlib
+import queue
+import time
+import os
+
+from radar_robotcar_dataset_sdk.downloader.download_item import download_item_size_GB, download_item_filename, \
+    download_item_available
+from radar_robotcar_dataset_sdk.downloader.download_journal import DOWNLOADED, VERIFIED
+from radar_robotcar_dataset_sdk.downloader.remote_zip_reader import extract_remote_members
+from radar_robotcar_dataset_sdk.downloader.zip_extractor import extract_zip, extract_zip_stream, verify_extraction
+
+_ls = "=" * 100  # Logging separator
+
+
+class StageTimer:
+    def __init__(self, event_log=None):
+        self._lock = threading.Lock()
+        self._stages = OrderedDict()
+        self.event_log = event_log
+
+    def add(self, stage, seconds, downld=None, num_bytes=None):
+        with self._lock:
+            count, total = self._stages.get(stage, (0, 0.))
+            self._stages[stage] = (count + 1, total + seconds)
+        if self.event_log is not None:
+            self.event_log.stage_event(stage, seconds, downld, num_bytes)
+
+    def report(self, wall_time, workers):
+        print(f"\n{_ls}\nStage timings (wall time {wall_time:.1f} s)\n{_ls}")
+        print(f"{'Stage':40} : {'Count':>6} - {'Total (s)':>10} - {'Mean (s)':>9} - {'Utilisation':>11}")
+        with self._lock:
+            stages = list(self._stages.items())
+        for stage, (count, total) in stages:
+            # Utilisation is relative to the worker-seconds available to the stage, the busiest stage is the bottleneck
+            available = wall_time * workers.get(stage.split()[0], 1)
+            utilisation = total / available if available > 0 else 0.
+            print(f"{stage:40} : {count:>6} - {total:>10.1f} - {total / max(count, 1):>9.1f} - {utilisation:>10.0%}")
+
+
+class DownloadScheduler:
+    def __init__(self, gdrive_handler, download_folder, parallel_downloads=1, largest_first=False,
+                 extract_workers=1, extract_queue_depth=1, extract_processes=1, stream_extract=False,
+                 batch_downloads=1, journal=None, remote_metadata=None, verify_md5=False, event_log=None,
+                 on_complete=None, member_filter=None, member_workers=4, transfer_controller=None,
+                 archive_cache=None):
+        if parallel_downloads < 1:
+            raise ValueError(f"parallel_downloads must be at least 1: {parallel_downloads}")
+        if extract_workers < 1:
+            raise ValueError(f"extract_workers must be at least 1: {extract_workers}")
+        if extract_queue_depth < 1:
+            raise ValueError(f"extract_queue_depth must be at least 1: {extract_queue_depth}")
+        if batch_downloads < 1:
+            raise ValueError(f"batch_downloads must be at least 1: {batch_downloads}")
+        self.gdrive_handler = gdrive_handler
+        self.download_folder = download_folder
+        self.parallel_downloads = parallel_downloads
+        self.largest_first = largest_first
+        self.extract_workers = extract_workers
+        self.extract_queue_depth = extract_queue_depth
+        self.extract_processes = extract_processes
+        self.stream_extract = stream_extract
+        self.batch_downloads = batch_downloads
+        self.journal = journal
+        # Exact sizes and hashes from GDriveHandler.get_remote_metadata, used in preference to the scraped sizes
+        self.remote_metadata = remote_metadata
+        self.verify_md5 = verify_md5
+        self.event_log = event_log
+        # Called with each DownloadItem from the worker threads once it is unpacked, blocking in it holds back the
+        # workers so a slow consumer throttles the pipeline
+        self.on_complete = on_complete
+        # Only the members accepted by member_filter(member_name) are read from each archive with ranged reads
+        self.member_filter = member_filter
+        self.member_workers = member_workers
+        # Retries failed transfers later and adapts the number running at once, without one a failure ends the run
+        self.transfer_controller = transfer_controller
+        # Archives are unpacked once into the shared cache and linked from there into download_folder
+        self.archive_cache = archive_cache
+        self.timer = StageTimer(event_log)
+        self._lock = threading.Lock()
+        self._errors = []
+        self._stop = threading.Event()
+        self._completed = 0
+        self._completed_size = 0.
+        self._num_downloads = 0
+        self._total_size = 0.
+
+    def run(self, downloads):
+        items = []
+        for di, downld in enumerate(downloads):
+            if download_item_available(downld):
+                items.append(downld)
+            else:
+                print(f"\nSkipping {di:4} / {len(downloads):4} : {downld.dataset:48} - {downld.sensor:25} - "
+                      f"Sorry this download isn't available yet, but it will be soon.")
+        if self.journal is not None:
+            finished = [downld for downld in items if self.journal.is_finished(downld)]
+            for downld in finished:
+                print(f"\nSkipping {downld.dataset:48} - {downld.sensor:25} - already {self.journal.state(downld)}")
+            items = [downld for downld in items if not self.journal.is_finished(downld)]
+            self.journal.add_pending(items)
+        if self.largest_first:
+            # Start the long transfers first so they do not all land at the end of the run
+            items = sorted(items, key=self._item_size_GB, reverse=True)
+
+        self.timer = StageTimer(self.event_log)
+        self._errors = []
+        self._stop.clear()
+        self._completed = 0
+        self._completed_size = 0.
+        self._num_downloads = len(items)
+        self._total_size = sum(self._item_size_GB(item) for item in items)
+        start_time = time.time()
+
+        if self.member_filter is not None:
+            print(f"\nExtracting selected members of {len(items)} files ({self._total_size:.2f} GB) with "
+                  f"{self.parallel_downloads} parallel files and {self.member_workers} ranged reads per file")
+        elif self.stream_extract:
+            print(f"\nDownloading {len(items)} files ({self._total_size:.2f} GB) with {self.parallel_downloads} "
+                  f"parallel transfers, unpacking as they stream")
+        else:
+            print(f"\nDownloading {len(items)} files ({self._total_size:.2f} GB) with {self.parallel_downloads} "
+                  f"parallel transfers and {self.extract_workers} extract workers "
+                  f"(queue depth {self.extract_queue_depth})")
+
+        # Download stage -> bounded queue of finished zips -> extract stage
+        # The bounded queue limits how many downloaded but not yet unpacked zips can be on disk at once
+        download_jobs = queue.Queue()
+        for di, downld in enumerate(items):
+            download_jobs.put((di, downld))
+        extract_jobs = queue.Queue(maxsize=self.extract_queue_depth)
+
+        download_threads = [threading.Thread(target=self._download_worker,
+                                             args=(download_jobs, extract_jobs), daemon=True)
+                            for _ in range(self.parallel_downloads)]
+        extract_threads = [threading.Thread(target=self._extract_worker,
+                                            args=(extract_jobs,), daemon=True)
+                           for _ in range(self.extract_workers)]
+        for thread in download_threads + extract_threads:
+            thread.start()
+        for thread in download_threads:
+            thread.join()
+        for _ in extract_threads:
+            extract_jobs.put(None)
+        for thread in extract_threads:
+            thread.join()
+
+        wall_time = time.time() - start_time
+        self.timer.report(wall_time, {'download': self.parallel_downloads, 'extract': self.extract_workers,
+                                      'delete': self.extract_workers})
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+        print(f"\nDownloaded {self._completed} files ({self._completed_size:.2f} GB) in {wall_time:.1f} s")
+
+    def stop(self):
+        # Workers finish their current file and exit, run() then returns
+        self._stop.set()
+
+    def _fail(self, error):
+        with self._lock:
+            self._errors.append(error)
+        if self.event_log is not None:
+            self.event_log.event('error', error=repr(error))
+        self._stop.set()
+
+    def _next_download_jobs(self, download_jobs):
+        # Streamed and partial extraction read one archive at a time so they are never batched
+        batch_size = 1 if self.stream_extract or self.member_filter is not None else self.batch_downloads
+        jobs = []
+        while len(jobs) < batch_size:
+            try:
+                jobs.append(download_jobs.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def _download_worker(self, download_jobs, extract_jobs):
+        while not self._stop.is_set():
+            jobs = self._next_download_jobs(download_jobs)
+            if len(jobs) == 0 and self.transfer_controller is not None:
+                # Files waiting to be retried keep the worker alive once the queue is empty
+                retry_job = self.transfer_controller.next_retry(self._stop)
+                jobs = [retry_job] if retry_job is not None else []
+            if len(jobs) == 0:
+                return
+            try:
+                self._download_jobs(jobs, extract_jobs)
+            except Exception as e:
+                if self.transfer_controller is not None and self.transfer_controller.retry_later(jobs, e):
+                    continue
+                self._fail(e)
+                return
+
+    def _transfer_slot(self):
+        if self.transfer_controller is None:
+            return nullcontext(True)
+        return self.transfer_controller.slot(self._stop)
+
+    def _transfer_succeeded(self):
+        if self.transfer_controller is not None:
+            self.transfer_controller.on_success()
+
+    def _download_jobs(self, jobs, extract_jobs):
+        for di, downld in jobs:
+            print(f"\nDownloading {di:4} / {self._num_downloads:4} : {downld.dataset:48} - "
+                  f"{downld.sensor:25} - {downld.size:17} - {downld.link:100}\n")
+        if self.member_filter is not None:
+            with self._transfer_slot() as acquired:
+                if not acquired:
+                    return
+                download_time = self._download_members(jobs[0][1])
+            self._transfer_succeeded()
+            # Outside the slot, on_complete can block on a slow consumer
+            self._complete(jobs[0][1], download_time)
+            return
+        jobs = [(di, downld) for di, downld in jobs if not self._link_from_cache(downld)]
+        if len(jobs) == 0:
+            return
+        if self.stream_extract:
+            with self._transfer_slot() as acquired:
+                if not acquired:
+                    return
+                download_time = self._download_and_extract_stream(jobs[0][1])
+            self._transfer_succeeded()
+            self._complete(jobs[0][1], download_time)
+            return
+        jobs = self._resume_downloaded_jobs(jobs, extract_jobs)
+        if len(jobs) == 0:
+            return
+
+        progress = self.parallel_downloads == 1
+        with self._transfer_slot() as acquired:
+            if not acquired:
+                # Stopping, the run is failing or its consumer has gone
+                return
+            start_time = time.time()
+            if len(jobs) == 1:
+                downloaded_zip_file_paths = [self.gdrive_handler.download_filename(
+                    download_item_filename(jobs[0][1]), progress=progress,
+                    stats_callback=self._stats_callback(jobs[0][1]))]
+            else:
+                downloaded_zip_file_paths = self.gdrive_handler.download_filenames(
+                    [download_item_filename(downld) for _, downld in jobs], progress=progress,
+                    stats_callback=self._stats_callback(None))
+            download_time = time.time() - start_time
+            self.timer.add('download', download_time, jobs[0][1] if len(jobs) == 1 else None,
+                           sum(os.path.getsize(path) for path in downloaded_zip_file_paths))
+            for (_, downld), downloaded_zip_file_path in zip(jobs, downloaded_zip_file_paths):
+                self._check_download(downld, downloaded_zip_file_path)
+        self._transfer_succeeded()
+        if len(jobs) > 1:
+            batch_size = sum(self._item_size_GB(downld) for _, downld in jobs)
+            print(f"\nDownloaded batch of {len(jobs)} files : {batch_size:.2f} GB in {download_time:.1f} s "
+                  f"({batch_size * 1024 / max(download_time, 1e-6):.1f} MB/s)")
+            # Files in a batch are transferred together so there is no meaningful per-file time
+            download_time = None
+
+        for (_, downld), downloaded_zip_file_path in zip(jobs, downloaded_zip_file_paths):
+            if self.journal is not None:
+                self.journal.set_state(downld, DOWNLOADED, zip_path=downloaded_zip_file_path)
+            self._put_extract_job(extract_jobs, (downld, downloaded_zip_file_path, download_time))
+
+    def _stats_callback(self, downld):
+        if self.event_log is None or not self.event_log.enabled:
+            return None
+        return lambda stats: self.event_log.rclone_stats(stats, downld)
+
+    def _resume_downloaded_jobs(self, jobs, extract_jobs):
+        # Zips left over from an interrupted run go straight to the extract stage
+        if self.journal is None:
+            return jobs
+        remaining_jobs = []
+        for di, downld in jobs:
+            downloaded_zip_file_path = self.journal.downloaded_zip_file_path(downld)
+            if downloaded_zip_file_path is None:
+                remaining_jobs.append((di, downld))
+            else:
+                print(f"Resuming from downloaded zip: {downloaded_zip_file_path}")
+                self._put_extract_job(extract_jobs, (downld, downloaded_zip_file_path, None))
+        return remaining_jobs
+
+    def _put_extract_job(self, extract_jobs, job):
+        start_time = time.time()
+        while not self._stop.is_set():
+            try:
+                extract_jobs.put(job, timeout=1.)
+                break
+            except queue.Full:
+                continue
+        self.timer.add('download (waiting for extract queue)', time.time() - start_time)
+
+    def _download_and_extract_stream(self, downld):
+        # The zip is unpacked straight from the rclone pipe so transfer and extraction are a single stage
+        filename = download_item_filename(downld)
+        print(f"\nStreaming {filename} into: {self.download_folder} ...")
+        start_time = time.time()
+
+        def extract(output_dir):
+            # Opened here so nothing is transferred if another run fills the archive cache first
+            with self.gdrive_handler.stream_filename(filename) as stream:
+                return extract_zip_stream(stream, output_dir)
+
+        extraction_stats = self._extract_into_download_folder(downld, extract)
+        download_time = time.time() - start_time
+        self.timer.add('download (streamed extract)', download_time, downld, extraction_stats.bytes)
+        print(f"Extracted {filename} : {extraction_stats}")
+        if self.journal is not None:
+            # Every member's size and CRC-32 is checked as it streams
+            self.journal.set_state(downld, VERIFIED, members=extraction_stats.members,
+                                   timestamps=list(extraction_stats.timestamps))
+        return download_time
+
+    def _download_members(self, downld):
+        # Not recorded in the journal, a partial extraction must not stop a later run fetching the whole archive
+        filename = download_item_filename(downld)
+        metadata = self._item_metadata(downld)
+        if metadata is None:
+            metadata = self.gdrive_handler.get_remote_metadata().get(filename)
+        if metadata is None:
+            raise RuntimeError(f"{filename} not found in the Google Drive listing")
+        print(f"\nExtracting selected members of {filename} into: {self.download_folder} ...")
+        start_time = time.time()
+        extraction_stats = extract_remote_members(self.gdrive_handler, filename, metadata.size, self.download_folder,
+                                                  self.member_filter, workers=self.member_workers)
+        download_time = time.time() - start_time
+        self.timer.add('download (selected members)', download_time, downld, extraction_stats.bytes)
+        print(f"Extracted {filename} : {extraction_stats}")
+        return download_time
+
+    def _extract_worker(self, extract_jobs):
+        while True:
+            start_time = time.time()
+            job = extract_jobs.get()
+            if job is None:
+                return
+            self.timer.add('extract (waiting for downloads)', time.time() - start_time)
+            if self._stop.is_set():
+                # Drain the queue so blocked download workers can exit
+                continue
+            downld, downloaded_zip_file_path, download_time = job
+            try:
+                print(f"\nExtracting into: {self.download_folder} ...")
+                start_time = time.time()
+                extraction_stats = self._extract_into_download_folder(
+                    downld, lambda output_dir: extract_zip(downloaded_zip_file_path, output_dir,
+                                                           workers=self.extract_processes))
+                self.timer.add('extract', time.time() - start_time, downld, extraction_stats.bytes)
+                print(f"Extracted {os.path.basename(downloaded_zip_file_path)} : {extraction_stats}")
+                if self.journal is not None:
+                    # Only recorded once verified, so a failed verification leaves the zip to be extracted again
+                    bad_members = verify_extraction(downloaded_zip_file_path, self.download_folder)
+                    if len(bad_members) > 0:
+                        raise RuntimeError(f"Extraction of {downloaded_zip_file_path} could not be verified, "
+                                           f"{len(bad_members)} members missing or the wrong size e.g. "
+                                           f"{bad_members[0]}")
+                    self.journal.set_state(downld, VERIFIED, members=extraction_stats.members,
+                                           timestamps=list(extraction_stats.timestamps))
+
+                print(f"Deleting Zip File {downloaded_zip_file_path} ...")
+                start_time = time.time()
+                os.remove(downloaded_zip_file_path)
+                self.timer.add('delete', time.time() - start_time, downld)
+                self._complete(downld, download_time)
+            except Exception as e:
+                self._fail(e)
+
+    def _link_from_cache(self, downld):
+        # Returns True if the item was already in the archive cache and is now linked into download_folder
+        if self.archive_cache is None or not self.archive_cache.contains(downld, self._item_metadata(downld)):
+            return False
+        print(f"\nLinking {download_item_filename(downld)} from the archive cache into: {self.download_folder}")
+        link_stats = self.archive_cache.link(downld, self._item_metadata(downld), self.download_folder)
+        if link_stats is None:
+            print(f"{download_item_filename(downld)} was evicted from the archive cache, downloading it instead")
+            return False
+        self.timer.add('link from cache', link_stats.seconds, downld, link_stats.bytes)
+        if self.journal is not None:
+            self.journal.set_state(downld, VERIFIED, members=link_stats.members,
+                                   timestamps=list(link_stats.timestamps), cached=True)
+        self._complete(downld, None)
+        return True
+
+    def _extract_into_download_folder(self, downld, extract):
+        # extract(output_dir) unpacks the archive and returns its ExtractionStats
+        if self.archive_cache is None:
+            return extract(self.download_folder)
+        metadata = self._item_metadata(downld)
+        extraction_stats = None
+        with self.archive_cache.populating(downld, metadata) as cache_tree_dir:
+            if cache_tree_dir is not None:
+                extraction_stats = extract(cache_tree_dir)
+        link_stats = self.archive_cache.link(downld, metadata, self.download_folder)
+        if link_stats is None:
+            # Evicted by another run since it was filled
+            print(f"{download_item_filename(downld)} was evicted from the archive cache, extracting it directly")
+            return extract(self.download_folder)
+        self.timer.add('link from cache', link_stats.seconds, downld, link_stats.bytes)
+        # None if another run filled the cache entry first
+        return extraction_stats if extraction_stats is not None else link_stats._replace(seconds=0.)
+
+    def _item_size_GB(self, downld):
+        metadata = self._item_metadata(downld)
+        return metadata.size / 1024 ** 3 if metadata is not None else download_item_size_GB(downld)
+
+    def _item_metadata(self, downld):
+        if self.remote_metadata is None:
+            return None
+        return self.remote_metadata.get(download_item_filename(downld))
+
+    def _check_download(self, downld, downloaded_zip_file_path):
+        metadata = self._item_metadata(downld)
+        if metadata is None:
+            return
+        start_time = time.time()
+        size = os.path.getsize(downloaded_zip_file_path)
+        if size != metadata.size:
+            raise RuntimeError(f"Downloaded file {downloaded_zip_file_path} is {size} bytes but {metadata.size} bytes "
+                               f"were expected")
+        if self.verify_md5 and metadata.md5 is not None:
+            md5 = hashlib.md5()
+            with open(downloaded_zip_file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                    md5.update(chunk)
+            if md5.hexdigest() != metadata.md5.lower():
+                raise RuntimeError(f"MD5 mismatch for downloaded file {downloaded_zip_file_path}: "
+                                   f"{md5.hexdigest()} != {metadata.md5}")
+        self.timer.add('download (integrity check)', time.time() - start_time, downld, size)
+
+    def _complete(self, downld, download_time):
+        size = self._item_size_GB(downld)
+        if download_time is None:
+            timing = ""
+        else:
+            timing = f" in {download_time:.1f} s ({size * 1024 / max(download_time, 1e-6):.1f} MB/s)"
+        with self._lock:
+            self._completed += 1
+            self._completed_size += size
+            print(f"\nFinished {downld.dataset} - {downld.sensor} : {size:.2f} GB downloaded{timing} - "
+                  f"total {self._completed} / {self._num_downloads} files, "
+                  f"{self._completed_size:.2f} / {self._total_size:.2f} GB")
+        if self.on_complete is not None:
+            self.on_complete(downld)
@@ -0,0 +1,123 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+import hashlib
+import socket
+import json
+import time
+import os
+
+from radar_robotcar_dataset_sdk.downloader.download_item import DownloadItem, download_item_size_GB, \
+    download_item_filename, download_item_available
+from radar_robotcar_dataset_sdk.downloader.download_journal import DownloadJournal
+
+# Splits one selection of downloads across hosts writing to the same shared download folder
+# Every host computes the same assignment from the same catalogue, so no coordination is needed between them
+
+_manifest_name_format = ".rrcd_shard_{:04d}_of_{:04d}.json"
+_journal_name_format = ".rrcd_download_journal_shard_{:04d}_of_{:04d}.json"
+
+RUNNING = "running"
+COMPLETE = "complete"
+
+
+def selection_id(downloads):
+    # Identifies the selection independently of its order, shards of different selections must not be merged
+    filenames = sorted(download_item_filename(downld) for downld in downloads)
+    return hashlib.sha1("\n".join(filenames).encode()).hexdigest()[:16]
+
+
+def shard_downloads(downloads, num_shards):
+    # Largest first onto the least loaded shard (ties broken by name and shard index) so archives that differ in size
+    # by orders of magnitude still give shards of about the same total size
+    if num_shards < 1:
+        raise ValueError(f"num_shards must be at least 1: {num_shards}")
+    shards = [[] for _ in range(num_shards)]
+    shard_sizes = [0.] * num_shards
+    for downld in sorted(downloads, key=lambda d: (-download_item_size_GB(d), download_item_filename(d))):
+        shard_index = min(range(num_shards), key=lambda i: (shard_sizes[i], i))
+        shards[shard_index].append(downld)
+        shard_sizes[shard_index] += download_item_size_GB(downld)
+    # Each shard keeps the catalogue order
+    order = {download_item_filename(downld): i for i, downld in enumerate(downloads)}
+    return [sorted(shard, key=lambda d: order[download_item_filename(d)]) for shard in shards]
+
+
+def shard_journal_name(shard_index, num_shards):
+    return _journal_name_format.format(shard_index, num_shards)
+
+
+def shard_manifest_path(download_folder, shard_index, num_shards):
+    return os.path.join(download_folder, _manifest_name_format.format(shard_index, num_shards))
+
+
+def write_shard_manifest(download_folder, shard_index, num_shards, downloads, shard, status):
+    manifest = {'shard_index': shard_index, 'num_shards': num_shards, 'selection': selection_id(downloads),
+                'selection_size': len(downloads), 'journal': shard_journal_name(shard_index, num_shards),
+                'status': status, 'host': socket.gethostname(), 'updated_at': time.time(),
+                'items': [{'dataset': downld.dataset, 'sensor': downld.sensor, 'size': downld.size}
+                          for downld in shard]}
+    path = shard_manifest_path(download_folder, shard_index, num_shards)
+    os.makedirs(download_folder, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+    return path
+
+
+def merge_shards(download_folder, downloads, num_shards):
+    # Returns a list of problems, empty once every available item of the selection is unpacked in download_folder
+    problems = []
+    expected_selection = selection_id(downloads)
+    owners = {}
+    for shard_index in range(num_shards):
+        path = shard_manifest_path(download_folder, shard_index, num_shards)
+        if not os.path.isfile(path):
+            problems.append(f"Shard {shard_index} / {num_shards}: no manifest at {path}")
+            continue
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest['selection'] != expected_selection:
+            problems.append(f"Shard {shard_index} / {num_shards}: downloaded a different selection "
+                            f"({manifest['selection']} != {expected_selection}), check the catalogue and filters "
+                            f"match")
+            continue
+        if manifest['status'] != COMPLETE:
+            problems.append(f"Shard {shard_index} / {num_shards}: not complete (host {manifest['host']})")
+        journal = DownloadJournal(download_folder, manifest['journal'])
+        if not os.path.isfile(journal.path):
+            # Run with --nojournal, only the manifest status and the unpacked folders can be checked
+            journal = None
+        for item in manifest['items']:
+            key = download_item_filename(DownloadItem(item['dataset'], item['sensor'], item['size'], ""))
+            if key in owners:
+                problems.append(f"{key}: assigned to shards {owners[key][0]} and {shard_index}")
+                continue
+            owners[key] = (shard_index, journal)
+
+    for downld in downloads:
+        if not download_item_available(downld):
+            continue
+        key = download_item_filename(downld)
+        if key not in owners:
+            problems.append(f"{key}: not in any shard manifest")
+            continue
+        shard_index, journal = owners[key]
+        if journal is not None and not journal.is_finished(downld):
+            problems.append(f"{key}: {journal.state(downld)} in shard {shard_index}")
+        elif not os.path.isdir(os.path.join(download_folder, downld.dataset)):
+            problems.append(f"{key}: finished in shard {shard_index} but {downld.dataset} is missing")
+    return problems
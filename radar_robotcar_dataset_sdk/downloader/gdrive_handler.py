@@ -13,8 +13,14 @@
 ###############################################################################
 
 from __future__ import division, print_function, absolute_import
+from contextlib import contextmanager
+from collections import namedtuple, deque
 import os.path
 import subprocess
+import sys
+import tempfile
+import json
+import time
 import os
 import shutil
 
@@ -26,24 +32,97 @@ _rclone_version = "v1.50.1"
 _rclone_install_script_path = os.path.join(_current_dir, 'rclone', "install.sh")
 _rclone_patched_install_script_name = "patched_rclone_install.sh"
 _rclone_binary_name = "rclone"
+_rclone_version_stamp_name = ".rclone_version_stamp.json"
+_rclone_stats_args = ["--stats", "5s", "--stats-log-level", "NOTICE", "--use-json-log"]
+# One line stats in the log rather than --progress, which moves rclone's log onto stdout where failures (e.g. a Drive
+# quota) could not be classified
+_rclone_progress_args = ["--stats", "1s", "--stats-one-line", "--stats-log-level", "NOTICE"]
+_rclone_stderr_tail_lines = 50
+_rclone_exit_timeout = 5.  # Seconds a streaming rclone gets to exit after its output ends early
 _rclone_rrcd_conf_unauthorised_name = "rclone_rrcd_unauthorised.conf"
 _rclone_rrcd_conf_authorised_name = "rclone_rrcd.conf"
 _rclone_rrcd_conf_drive_path = "rrcd_drive:"
 _rclone_rrcd_conf_unauthorised_path = os.path.join(_current_dir, _rclone_rrcd_conf_unauthorised_name)
 
+RemoteFileMetadata = namedtuple('RemoteFileMetadata', ['size', 'modtime', 'md5'])
+
 
 class GDriveHandler:
-    def __init__(self, download_dir):
+    def __init__(self, download_dir, transfers=None, checkers=None, drive_chunk_size=None, rclone_dir=None,
+                 event_log=None):
         self.download_dir = download_dir
-        self.bin, self.config = _initialise_dir_with_rclone(self.download_dir)
+        if not os.path.isdir(self.download_dir):
+            os.makedirs(self.download_dir)
+        # Many download folders can share one rclone install (and authorised config) in rclone_dir
+        self.rclone_dir = rclone_dir if rclone_dir is not None else download_dir
+        self.event_log = event_log
+        start_time = time.time()
+        self.bin, self.config = _initialise_dir_with_rclone(self.rclone_dir)
+        if self.event_log is not None:
+            self.event_log.stage_event('rclone_setup', time.time() - start_time)
         self.call_args = [self.bin, "--config", self.config, "--drive-shared-with-me"]
+        # rclone transfer tuning, None keeps the rclone default
+        self.copy_args = []
+        if transfers is not None:
+            self.copy_args += ["--transfers", str(transfers)]
+        if checkers is not None:
+            self.copy_args += ["--checkers", str(checkers)]
+        if drive_chunk_size is not None:
+            self.copy_args += ["--drive-chunk-size", str(drive_chunk_size)]
+        self._remote_metadata = None
+        start_time = time.time()
         self.__authorise_if_needed()
+        if self.event_log is not None:
+            self.event_log.stage_event('auth_check', time.time() - start_time)
 
-    def download_filename(self, filename):
-        output_path_raw = os.path.join(self.download_dir, filename)
-        args = self.call_args + ["--progress", "copy", _rclone_rrcd_conf_drive_path + filename, self.download_dir]
+    def get_remote_metadata(self, refresh=False):
+        # One `rclone lsjson` listing of the whole shared drive gives exact sizes, modtimes and MD5s for every file
+        if self._remote_metadata is None or refresh:
+            args = self.call_args + ["lsjson", "--hash", "--files-only", _rclone_rrcd_conf_drive_path]
+            listing = json.loads(subprocess.check_output(args).decode())
+            self._remote_metadata = {}
+            for entry in listing:
+                # Hash names are upper case in older rclone versions and lower case in newer ones
+                hashes = {k.lower(): v for k, v in (entry.get('Hashes') or {}).items()}
+                self._remote_metadata[entry['Path']] = RemoteFileMetadata(entry['Size'], entry['ModTime'],
+                                                                          hashes.get('md5'))
+        return self._remote_metadata
+
+    def download_filename(self, filename, progress=True, stats_callback=None):
+        # Interleaved progress bars are unreadable so concurrent callers can turn them off
+        progress_args = self.__progress_args(progress, stats_callback)
+        args = self.call_args + self.copy_args + progress_args + \
+            ["copy", _rclone_rrcd_conf_drive_path + filename, self.download_dir]
+
+        _run_rclone(args, stats_callback)
+        return self.__add_zip_extension(filename)
+
+    def download_filenames(self, filenames, progress=True, stats_callback=None):
+        # A single rclone invocation for the whole selection so process start up, Drive listing and token refresh
+        # are paid once and rclone's own --transfers parallelism and connection reuse do the work
+        progress_args = self.__progress_args(progress, stats_callback)
+        with tempfile.NamedTemporaryFile('w', prefix='rclone_files_from_', suffix='.txt', dir=self.download_dir,
+                                         delete=False) as f:
+            f.write("\n".join(filenames) + "\n")
+            files_from_path = f.name
+        args = self.call_args + self.copy_args + progress_args + \
+            ["--files-from", files_from_path, "copy", _rclone_rrcd_conf_drive_path, self.download_dir]
+
+        try:
+            _run_rclone(args, stats_callback)
+        finally:
+            os.remove(files_from_path)
+        return [self.__add_zip_extension(filename) for filename in filenames]
 
-        subprocess.check_call(args)
+    @staticmethod
+    def __progress_args(progress, stats_callback):
+        # Machine readable stats replace the TTY progress output when a callback wants them
+        if stats_callback is not None:
+            return _rclone_stats_args
+        return _rclone_progress_args if progress else []
+
+    def __add_zip_extension(self, filename):
+        output_path_raw = os.path.join(self.download_dir, filename)
         if not os.path.isfile(output_path_raw):
             raise RuntimeError('Unexpected error in downloading file to: {}'.format(output_path_raw))
 
@@ -54,6 +133,52 @@ class GDriveHandler:
 
         return output_path_zip
 
+    @contextmanager
+    def stream_filename(self, filename):
+        # Yields the file contents as a pipe from `rclone cat` so nothing is written to download_dir
+        args = self.call_args + ["cat", _rclone_rrcd_conf_drive_path + filename]
+        # The log goes to a file rather than a pipe so a chatty rclone can never block on it while we read stdout
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr_file)
+            try:
+                yield process.stdout
+            except Exception as e:
+                # A failing rclone shows up first as a short stream (e.g. a BadZipFile from the reader), its own error
+                # is raised instead so it can be classified and retried, see transfer_controller
+                # An rclone still writing blocks on the full pipe and is killed, the reader's error then stands
+                try:
+                    return_code = process.wait(timeout=_rclone_exit_timeout)
+                except subprocess.TimeoutExpired:
+                    return_code = None
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+                if return_code is not None and return_code > 0:
+                    raise _rclone_error(return_code, args, stderr_file) from e
+                raise
+            except BaseException:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+                raise
+            process.stdout.close()
+            return_code = process.wait()
+            if return_code != 0:
+                raise _rclone_error(return_code, args, stderr_file)
+
+    def read_range(self, filename, offset, count):
+        # One ranged read of a remote file, used to read selected members of an archive without the rest of it
+        args = self.call_args + ["cat", "--offset", str(offset), "--count", str(count),
+                                 _rclone_rrcd_conf_drive_path + filename]
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, args, stderr=result.stderr.decode(errors='replace'))
+        data = result.stdout
+        if len(data) != count:
+            raise RuntimeError('Short read of {}: {} of {} bytes at offset {}'.format(filename, len(data), count,
+                                                                                      offset))
+        return data
+
     def __is_authorised(self):
         # We use the about call as a proxy for checking we are correctly authorised with Google Drive
         # I cannot find a better alternative than this at present
@@ -76,6 +201,72 @@ class GDriveHandler:
                 print("\nrclone authorised sucessfully")
 
 
+def _rclone_error(return_code, args, stderr_file):
+    stderr_file.seek(0)
+    stderr_tail = "".join(stderr_file.read().decode(errors='replace').splitlines(True)[-_rclone_stderr_tail_lines:])
+    sys.stderr.write(stderr_tail)
+    return subprocess.CalledProcessError(return_code, args, stderr=stderr_tail)
+
+
+def _run_rclone(args, stats_callback=None):
+    # rclone's log is passed through to stderr and its tail kept on failure so the cause (e.g. a Drive rate limit or
+    # quota) can be classified, see transfer_controller
+    # With --use-json-log every log line on stderr is a JSON object and the periodic ones carry a `stats` object
+    stderr_tail = deque(maxlen=_rclone_stderr_tail_lines)
+    process = subprocess.Popen(args, stderr=subprocess.PIPE, universal_newlines=True)
+    for line in process.stderr:
+        stderr_tail.append(line)
+        try:
+            log = json.loads(line)
+        except ValueError:
+            sys.stderr.write(line)
+            continue
+        if isinstance(log, dict) and 'stats' in log:
+            if stats_callback is not None:
+                stats_callback(log['stats'])
+        elif isinstance(log, dict) and log.get('level') in ('error', 'critical'):
+            sys.stderr.write("rclone {}: {} {}\n".format(log['level'], log.get('object', ''), log.get('msg', '')))
+    return_code = process.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, args, stderr="".join(stderr_tail))
+
+
+def _installed_rclone_version(rclone_path):
+    # The stamp is keyed by binary path, size and mtime so the binary is only run once per install
+    if not os.path.isfile(rclone_path):
+        return None
+    rclone_stat = os.stat(rclone_path)
+    stamp_key = {'path': os.path.abspath(rclone_path), 'size': rclone_stat.st_size, 'mtime': rclone_stat.st_mtime}
+    stamp_path = os.path.join(os.path.dirname(rclone_path), _rclone_version_stamp_name)
+    try:
+        with open(stamp_path) as f:
+            stamp = json.load(f)
+        if all(stamp.get(k) == v for k, v in stamp_key.items()):
+            return stamp['version']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    try:
+        output = subprocess.check_output([rclone_path, "--version"], stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # First line is e.g. `rclone v1.50.1`
+    version_line = output.splitlines()[0].split() if len(output) > 0 else []
+    if len(version_line) < 2:
+        return None
+    stamp_key['version'] = version_line[1]
+
+    # Written via a rename so concurrent jobs sharing the install never see a partial stamp
+    tmp_stamp_path = "{}.{}.tmp".format(stamp_path, os.getpid())
+    try:
+        with open(tmp_stamp_path, 'w') as f:
+            json.dump(stamp_key, f)
+        os.replace(tmp_stamp_path, stamp_path)
+    except OSError:
+        pass
+    return stamp_key['version']
+
+
 def _initialise_dir_with_rclone(install_dir, create_dir_if_needed=True):
     ##########################################################################################
     # Create directory if necessary
@@ -89,11 +280,20 @@ def _initialise_dir_with_rclone(install_dir, create_dir_if_needed=True):
 
     ##########################################################################################
     # Run modified rclone install script with download folder and rclone version
+    # (skipped when the binary already in install_dir is the requested version)
     ##########################################################################################
     print("{}\nInitialising rclone to: {}\n{}".format(_ls, install_dir, _ls))
-    return_code = subprocess.call(['bash', _rclone_install_script_path, install_dir, _rclone_version],
-                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    if return_code == 0:
+    rclone_path = os.path.join(install_dir, _rclone_binary_name)
+    if _installed_rclone_version(rclone_path) == _rclone_version:
+        print('rclone install script: skipped as installed version of rclone is already at requested version: '
+              '{}'.format(_rclone_version))
+        return_code = None
+    else:
+        return_code = subprocess.call(['bash', _rclone_install_script_path, install_dir, _rclone_version],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if return_code is None:
+        pass
+    elif return_code == 0:
         print('rclone install script: exited without problems')
     elif return_code == 1:
         raise RuntimeError(
@@ -111,7 +311,6 @@ def _initialise_dir_with_rclone(install_dir, create_dir_if_needed=True):
     ##########################################################################################
     # Check the rclone binary is found as expected
     ##########################################################################################
-    rclone_path = os.path.join(install_dir, _rclone_binary_name)
     if not os.path.isfile(rclone_path):
         raise FileNotFoundError('Unexpected error. rclone binary not found after running install script: '
                                 '{}'.format(rclone_path))
@@ -0,0 +1,104 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from contextlib import contextmanager
+from collections import OrderedDict
+import threading
+import json
+import time
+import os
+
+# Machine readable JSON-lines events for sizing bandwidth and catching regressions in ingest jobs
+# An EventLog without a path records the run summary but writes nothing
+
+
+def _MB_per_second(num_bytes, seconds):
+    if num_bytes is None or seconds <= 0:
+        return None
+    return num_bytes / 1024 ** 2 / seconds
+
+
+class EventLog:
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._file = open(path, 'a')
+        self._stages = OrderedDict()
+        self._start_time = time.time()
+        self.event('run_start', pid=os.getpid())
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def event(self, event, **fields):
+        record = OrderedDict([('time', time.time()), ('event', event)])
+        record.update((k, v) for k, v in fields.items() if v is not None)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(record) + "\n")
+                self._file.flush()
+
+    def stage_event(self, stage, seconds, downld=None, num_bytes=None, status='ok', **fields):
+        with self._lock:
+            count, total_seconds, total_bytes = self._stages.get(stage, (0, 0., 0))
+            self._stages[stage] = (count + 1, total_seconds + seconds, total_bytes + (num_bytes or 0))
+        self.event('stage', stage=stage, status=status,
+                   dataset=downld.dataset if downld is not None else None,
+                   sensor=downld.sensor if downld is not None else None,
+                   seconds=seconds, bytes=num_bytes, MB_per_s=_MB_per_second(num_bytes, seconds), **fields)
+
+    @contextmanager
+    def stage(self, stage, downld=None, num_bytes=None):
+        # The yielded dict lets the caller fill in `bytes` once they are known
+        record = {'bytes': num_bytes}
+        start_time = time.time()
+        try:
+            yield record
+        except BaseException as e:
+            self.stage_event(stage, time.time() - start_time, downld, record['bytes'], status='error',
+                             error=repr(e))
+            raise
+        self.stage_event(stage, time.time() - start_time, downld, record['bytes'])
+
+    def rclone_stats(self, stats, downld=None):
+        # Periodic stats from `rclone --use-json-log --stats`, see https://rclone.org/rc/#core-stats
+        self.event('rclone_stats',
+                   dataset=downld.dataset if downld is not None else None,
+                   sensor=downld.sensor if downld is not None else None,
+                   bytes=stats.get('bytes'), total_bytes=stats.get('totalBytes'),
+                   MB_per_s=stats['speed'] / 1024 ** 2 if stats.get('speed') is not None else None,
+                   eta=stats.get('eta'), errors=stats.get('errors'), transfers=stats.get('transfers'),
+                   retry_error=stats.get('retryError'),
+                   transferring=[t.get('name') for t in stats.get('transferring') or []] or None)
+
+    def summary(self):
+        wall_time = time.time() - self._start_time
+        with self._lock:
+            stages = OrderedDict(
+                (stage, OrderedDict([('count', count), ('seconds', seconds), ('bytes', num_bytes),
+                                     ('MB_per_s', _MB_per_second(num_bytes or None, seconds))]))
+                for stage, (count, seconds, num_bytes) in self._stages.items())
+        self.event('run_summary', wall_seconds=wall_time, stages=stages)
+        return stages
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
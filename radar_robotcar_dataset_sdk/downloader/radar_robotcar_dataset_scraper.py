@@ -14,33 +14,61 @@
 
 from __future__ import division, print_function, absolute_import
 from absl import app, flags
-import requests
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 import os
 from copy import deepcopy
 
+_default_dataset_url = "https://oxford-robotics-institute.github.io/radar-robotcar-dataset"
+_default_max_workers = 16
+
 FLAGS = flags.FLAGS
-flags.DEFINE_string("dataset_url", "https://oxford-robotics-institute.github.io/radar-robotcar-dataset",
-                    "Oxford Radar RobotCar Dataset url")
+flags.DEFINE_string("dataset_url", _default_dataset_url, "Oxford Radar RobotCar Dataset url")
 
 
 class DatasetScraper:
-    def __init__(self, base_url=None):
+    def __init__(self, base_url=None, max_workers=_default_max_workers):
+        # Imported here so importing this module (e.g. for its flags) does not pay for the HTTP stack
+        import requests
+
         base_url = base_url if base_url is not None else FLAGS.dataset_url
-        self.base_url = requests.get(base_url).url  # resolve redirects
+        self.max_workers = max_workers
+        # One pooled session so every page fetch reuses the same TLS connections
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.base_url = self.session.get(base_url).url  # resolve redirects
         self.datesets_url = f"{self.base_url}/datasets"
         self.downloads_url = f"{self.base_url}/downloads"
 
-    def get_dataset_list(self):
-        response = requests.get(self.datesets_url)
+    def get_page(self, url, validators=None):
+        # Conditional request when the ETag / Last-Modified of an earlier fetch are given, 304 if unchanged since
+        headers = {}
+        if validators is not None:
+            if validators.get('etag') is not None:
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified') is not None:
+                headers['If-Modified-Since'] = validators['last_modified']
+        response = self.session.get(url, headers=headers)
+        response.raise_for_status()
+        return response
+
+    def get_dataset_list(self, response=None):
+        from bs4 import BeautifulSoup
+
+        if response is None:
+            response = self.session.get(self.datesets_url)
         soup = BeautifulSoup(response.text, "html.parser")
         table_rows = soup.findAll('tr')
         datasets = [tr['href'] for tr in table_rows]
         datasets = [os.path.basename(d) for d in datasets]
         return datasets
 
-    def get_dataset_info(self, dataset):
-        response = requests.get(f"{self.datesets_url}/{dataset}")
+    def get_dataset_info(self, dataset, response=None):
+        from bs4 import BeautifulSoup
+
+        if response is None:
+            response = self.session.get(f"{self.datesets_url}/{dataset}")
         soup = BeautifulSoup(response.text, "html.parser")
         table_rows = soup.findAll('tr')
         dataset_info = {}
@@ -60,13 +88,25 @@ class DatasetScraper:
                 gps_size, gps_ext = sensor_info['GPS Size'].split(' ')[:2]
                 ins_size, ins_ext = sensor_info['INS Size'].split(' ')[:2]
                 assert gps_ext.strip() == ins_ext.strip()
-                sensor_info['Size'] = "{:.2f} {}".format(float(gps_size) + float(gps_size), gps_ext)
+                sensor_info['Size'] = "{:.2f} {}".format(float(gps_size) + float(ins_size), gps_ext)
             dataset_info[sensor_info_lines[0].strip()] = deepcopy(sensor_info)
 
         return dataset_info
 
-    def get_sample_dataset_list(self):
-        response = requests.get(self.downloads_url)
+    def get_all_dataset_info(self, datasets):
+        # Fetch all dataset pages concurrently, results keep the order of `datasets`
+        datasets = list(dict.fromkeys(datasets))
+        if len(datasets) == 0:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(datasets))) as executor:
+            dataset_infos = list(executor.map(self.get_dataset_info, datasets))
+        return dict(zip(datasets, dataset_infos))
+
+    def get_sample_dataset_list(self, response=None):
+        from bs4 import BeautifulSoup
+
+        if response is None:
+            response = self.session.get(self.downloads_url)
         soup = BeautifulSoup(response.text, "html.parser")
         sample_datasets_div = soup.find("div", {"id": "sample_datasets"})
         sample_datasets_elements = sample_datasets_div.find_all('li')
@@ -83,9 +123,8 @@ def main(unused_args):
     dataset_scraper = DatasetScraper()
     print("\nIndividual Dataset Downloads")
     dataset_list = dataset_scraper.get_dataset_list()
-    for dataset in dataset_list:
+    for dataset, dataset_info in dataset_scraper.get_all_dataset_info(dataset_list).items():
         print(dataset)
-        dataset_info = dataset_scraper.get_dataset_info(dataset_list[0])
         for sensor, info in dataset_info.items():
             print(f"  {sensor} - {info}")
 
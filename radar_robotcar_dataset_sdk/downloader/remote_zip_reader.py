@@ -0,0 +1,204 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+import threading
+import fnmatch
+import bisect
+import zipfile
+import time
+import io
+import os
+
+from radar_robotcar_dataset_sdk.downloader.zip_extractor import ExtractionStats, write_member
+
+# Extracts selected members of a remote zip without transferring the whole archive: the central directory and then
+# only the byte ranges of the wanted members are read with ranged `rclone cat` calls
+
+_block_size = 1024 * 1024  # Smallest read, the end of the archive is read in one block to find the central directory
+_max_cached_blocks = 16
+_merge_gap = 1024 * 1024  # Members closer than this are fetched in one call, as each call costs a round trip
+_max_span_size = 64 * 1024 * 1024  # Per call, so peak memory is roughly (2 * workers) * _max_span_size
+
+
+class RcloneRangeReader(io.RawIOBase):
+    # Seekable read only file object over a remote file for zipfile.ZipFile
+    # Reads come from prefetched spans when possible, otherwise from a small cache of blocks
+    def __init__(self, gdrive_handler, filename, size):
+        self.gdrive_handler = gdrive_handler
+        self.filename = filename
+        self.size = size
+        self.bytes_fetched = 0
+        self.requests = 0
+        self._position = 0
+        self._lock = threading.Lock()
+        self._spans = {}
+        self._blocks = OrderedDict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self._position = offset
+        elif whence == os.SEEK_CUR:
+            self._position += offset
+        elif whence == os.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if self._position < 0:
+            raise ValueError(f"Negative seek position: {self._position}")
+        return self._position
+
+    def fetch(self, offset, count):
+        data = self.gdrive_handler.read_range(self.filename, offset, count)
+        with self._lock:
+            self.bytes_fetched += len(data)
+            self.requests += 1
+        return data
+
+    def add_span(self, offset, data):
+        with self._lock:
+            self._spans[offset] = data
+
+    def remove_span(self, offset):
+        with self._lock:
+            self._spans.pop(offset, None)
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self._position
+        n = min(n, self.size - self._position)
+        chunks = []
+        while n > 0:
+            # A read can run past the end of a span into the next one or into an uncached block
+            data = self._read_span(self._position, n)
+            if data is None:
+                data = self._read_block(self._position, n)
+            chunks.append(data)
+            self._position += len(data)
+            n -= len(data)
+        return b"".join(chunks)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _read_span(self, position, n):
+        with self._lock:
+            for offset, data in self._spans.items():
+                if offset <= position < offset + len(data):
+                    return data[position - offset:position - offset + n]
+        return None
+
+    def _read_block(self, position, n):
+        block_start = position - position % _block_size
+        with self._lock:
+            block = self._blocks.get(block_start)
+        if block is None:
+            # Reads larger than a block are fetched in one call rather than block by block
+            block = self.fetch(block_start, min(max(_block_size, position + n - block_start),
+                                                self.size - block_start))
+            with self._lock:
+                self._blocks[block_start] = block
+                while len(self._blocks) > _max_cached_blocks:
+                    self._blocks.popitem(last=False)
+        return block[position - block_start:position - block_start + n]
+
+
+def member_timestamp(member_name):
+    # Sensor frames are named by their UNIX timestamp in microseconds e.g. `radar/1547131046353776.png`
+    stem = os.path.splitext(os.path.basename(member_name))[0]
+    return int(stem) if stem.isdigit() else None
+
+
+def make_member_filter(member_globs=None, timestamp_from=None, timestamp_to=None):
+    # Members must match one of the globs (if given) and, if named by a timestamp, be inside the timestamp range
+    # Members not named by a timestamp e.g. `radar.timestamps` are kept so each slice still has its metadata
+    def member_filter(member_name):
+        if member_globs is not None and not any(fnmatch.fnmatch(member_name, glob) for glob in member_globs):
+            return False
+        timestamp = member_timestamp(member_name)
+        if timestamp is None:
+            return True
+        if timestamp_from is not None and timestamp < timestamp_from:
+            return False
+        if timestamp_to is not None and timestamp > timestamp_to:
+            return False
+        return True
+    return member_filter
+
+
+def _member_spans(zip_file, infos):
+    # A member's local header and data run up to the next member (or the central directory), group the wanted
+    # members into spans that are each fetched with one call
+    boundaries = sorted(info.header_offset for info in zip_file.infolist()) + [zip_file.start_dir]
+    spans = []
+    for info in sorted(infos, key=lambda i: i.header_offset):
+        end = boundaries[bisect.bisect_right(boundaries, info.header_offset)]
+        if len(spans) > 0 and info.header_offset - spans[-1][1] <= _merge_gap and \
+                end - spans[-1][0] <= _max_span_size:
+            spans[-1][1] = end
+            spans[-1][2].append(info)
+        else:
+            spans.append([info.header_offset, end, [info]])
+    return spans
+
+
+def extract_remote_members(gdrive_handler, filename, size, output_dir, member_filter, workers=4):
+    start_time = time.time()
+    reader = RcloneRangeReader(gdrive_handler, filename, size)
+    num_members, num_bytes = 0, 0
+    with zipfile.ZipFile(reader, allowZip64=True) as zip_file:
+        infos = [info for info in zip_file.infolist() if member_filter(info.filename)]
+
+        def extract_span(start, span_infos, future):
+            members, written = 0, 0
+            reader.add_span(start, future.result())
+            for info in span_infos:
+                if info.is_dir():
+                    write_member(None, output_dir, info.filename, True)
+                else:
+                    with zip_file.open(info) as source:
+                        written += write_member(source, output_dir, info.filename, False)
+                members += 1
+            reader.remove_span(start)
+            return members, written
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # A bounded window of spans in flight keeps memory use flat however many members are selected
+            pending = deque()
+            for start, end, span_infos in _member_spans(zip_file, infos):
+                pending.append((start, span_infos, executor.submit(reader.fetch, start, end - start)))
+                if len(pending) >= 2 * workers:
+                    members, written = extract_span(*pending.popleft())
+                    num_members += members
+                    num_bytes += written
+            while len(pending) > 0:
+                members, written = extract_span(*pending.popleft())
+                num_members += members
+                num_bytes += written
+    print(f"Fetched {reader.bytes_fetched / 1024 ** 2:.1f} MB of {size / 1024 ** 2:.1f} MB in {reader.requests} "
+          f"ranged reads for {num_members} of the members")
+    return ExtractionStats(num_members, num_bytes, time.time() - start_time)
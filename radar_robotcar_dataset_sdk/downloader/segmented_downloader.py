@@ -0,0 +1,243 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import threading
+import zipfile
+import random
+import json
+import time
+import re
+import os
+
+from radar_robotcar_dataset_sdk.downloader.zip_extractor import extract_zip_stream, extract_zip
+
+_gdrive_download_url = "https://drive.google.com/uc?export=download"
+_default_segment_size = 64 * 1024 * 1024
+_read_size = 1024 * 1024
+_state_suffix = ".state.json"
+
+
+def resolve_gdrive_download_url(session, file_id):
+    # Public files over the virus scan limit return a confirmation page instead of the file
+    url = f"{_gdrive_download_url}&id={file_id}"
+    response = session.get(url, stream=True)
+    try:
+        response.raise_for_status()
+        if 'text/html' not in response.headers.get('Content-Type', ''):
+            return response.url
+        for name, value in response.cookies.items():
+            if name.startswith('download_warning'):
+                return f"{url}&confirm={value}"
+        html = response.text
+        form_action = re.search(r'<form[^>]*action="([^"]+)"', html)
+        if form_action is not None:
+            inputs = dict(re.findall(r'<input[^>]*name="([^"]+)"[^>]*value="([^"]*)"', html))
+            return f"{form_action.group(1).replace('&amp;', '&')}?{urlencode(inputs)}"
+        confirm = re.search(r'confirm=([0-9A-Za-z_-]+)', html)
+        if confirm is not None:
+            return f"{url}&confirm={confirm.group(1)}"
+    finally:
+        response.close()
+    raise RuntimeError(f"Could not find a download link for Google Drive file: {file_id}")
+
+
+class _CompletedPrefixReader:
+    # File-like view of the part of the download that is complete from the start, so a streaming unzip can follow
+    # the segment workers without waiting for the whole file
+    def __init__(self, downloader, path, size):
+        self._downloader = downloader
+        self._file = open(path, 'rb')
+        self._size = size
+        self._position = 0
+
+    def read(self, n):
+        if self._position >= self._size:
+            return b""
+        available = self._downloader.wait_for_prefix(self._position + 1)
+        data = self._file.read(min(n, available - self._position))
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class SegmentedDownloader:
+    def __init__(self, session=None, segments=8, segment_size=_default_segment_size, retries=5):
+        if session is None:
+            import requests
+
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=segments)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self.segments = segments
+        self.segment_size = segment_size
+        self.retries = retries
+        self._condition = threading.Condition()
+        self._done = set()
+        self._error = None
+        self._num_segments = 0
+        self._size = 0
+
+    def probe(self, url):
+        # Returns the file size if the server honours range requests, otherwise None
+        response = self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True)
+        try:
+            response.raise_for_status()
+            content_range = response.headers.get('Content-Range', '')
+            if response.status_code != 206 or '/' not in content_range:
+                return None
+            size = content_range.rsplit('/', 1)[1]
+            return int(size) if size.isdigit() else None
+        finally:
+            response.close()
+
+    def download(self, url, output_path, extract_dir=None):
+        size = self.probe(url)
+        if size is None:
+            print("Server does not support range requests, downloading as a single stream")
+            return self._download_single_stream(url, output_path, extract_dir)
+
+        state_path = output_path + _state_suffix
+        state = None
+        if os.path.isfile(state_path) and os.path.isfile(output_path):
+            with open(state_path) as f:
+                previous_state = json.load(f)
+            # The signed url changes between runs so the resume is keyed on the layout of the file
+            if previous_state['size'] == size and previous_state['segment_size'] == self.segment_size:
+                state = previous_state
+                print(f"Resuming download with {len(state['done'])} segments already complete")
+        if state is None:
+            state = {'url': url, 'size': size, 'segment_size': self.segment_size, 'done': []}
+            with open(output_path, 'wb') as f:
+                f.truncate(size)
+
+        self._size = size
+        self._num_segments = max(1, (size + self.segment_size - 1) // self.segment_size)
+        self._done = set(state['done'])
+        self._error = None
+        state_lock = threading.Lock()
+
+        def save_state():
+            with state_lock:
+                state['done'] = sorted(self._done)
+                with open(state_path + ".tmp", 'w') as f:
+                    json.dump(state, f)
+                os.replace(state_path + ".tmp", state_path)
+
+        def fetch_segment(index):
+            try:
+                self._fetch_segment(url, output_path, index)
+                with self._condition:
+                    self._done.add(index)
+                    self._condition.notify_all()
+                save_state()
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+                raise
+
+        start_time = time.time()
+        extraction_stats = None
+        with ThreadPoolExecutor(max_workers=self.segments) as executor:
+            futures = [executor.submit(fetch_segment, index) for index in range(self._num_segments)
+                       if index not in self._done]
+            if extract_dir is not None:
+                reader = _CompletedPrefixReader(self, output_path, size)
+                try:
+                    extraction_stats = extract_zip_stream(reader, extract_dir)
+                except zipfile.BadZipFile as e:
+                    # Members the stream reader cannot handle, unzip from the central directory once all segments
+                    # are on disk instead
+                    print(f"Could not unzip while downloading ({e}), unzipping once the download completes")
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+                finally:
+                    reader.close()
+            for future in futures:
+                future.result()
+        elapsed = time.time() - start_time
+        print(f"Downloaded {size / 1024 ** 2:.1f} MB in {self._num_segments} segments in {elapsed:.1f} s "
+              f"({size / 1024 ** 2 / max(elapsed, 1e-6):.1f} MB/s)")
+        if os.path.isfile(state_path):
+            os.remove(state_path)
+        if extract_dir is not None and extraction_stats is None:
+            extraction_stats = extract_zip(output_path, extract_dir)
+        return extraction_stats
+
+    def wait_for_prefix(self, position):
+        # Blocks until the first `position` bytes are on disk, returns the end of the completed prefix
+        with self._condition:
+            while True:
+                if self._error is not None:
+                    raise RuntimeError(f"Download failed: {self._error}")
+                prefix_segments = 0
+                while prefix_segments in self._done:
+                    prefix_segments += 1
+                prefix_end = min(prefix_segments * self.segment_size, self._size)
+                if prefix_end >= position:
+                    return prefix_end
+                self._condition.wait()
+
+    def _fetch_segment(self, url, output_path, index):
+        start = index * self.segment_size
+        end = min(start + self.segment_size, self._size) - 1
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True, timeout=60)
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise RuntimeError(f"Expected a partial response for segment {index}, got {response.status_code}")
+                written = 0
+                with open(output_path, 'r+b') as f:
+                    f.seek(start)
+                    for chunk in response.iter_content(_read_size):
+                        f.write(chunk)
+                        written += len(chunk)
+                if written != end - start + 1:
+                    raise RuntimeError(f"Segment {index} truncated: {written} of {end - start + 1} bytes")
+                return
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                # Jittered exponential backoff, each segment retries on its own
+                time.sleep(min(60., 2 ** attempt) * (0.5 + random.random() / 2))
+
+    def _download_single_stream(self, url, output_path, extract_dir):
+        response = self.session.get(url, stream=True)
+        try:
+            response.raise_for_status()
+            if extract_dir is not None:
+                response.raw.decode_content = True
+                try:
+                    return extract_zip_stream(response.raw, extract_dir)
+                except zipfile.BadZipFile as e:
+                    # The stream is part consumed, so download the whole file again and unzip it from disk
+                    print(f"Could not unzip while downloading ({e}), downloading the whole file first")
+                    self._download_single_stream(url, output_path, None)
+                    return extract_zip(output_path, extract_dir)
+            with open(output_path, 'wb') as f:
+                for chunk in response.iter_content(_read_size):
+                    f.write(chunk)
+        finally:
+            response.close()
+        return None
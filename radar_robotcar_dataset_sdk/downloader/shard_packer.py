@@ -0,0 +1,204 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+import shutil
+import json
+import time
+import os
+
+import numpy as np
+
+from radar_robotcar_dataset_sdk.downloader.zip_extractor import process_pool_context
+
+# Packs the hundreds of thousands of small frame files of each sensor (e.g. `radar/<timestamp>.png`) into a few large
+# shard files plus a timestamp -> (shard, offset, length) index, so training reads frames out of memory mapped shards
+# instead of opening a file per frame. Frames are stored exactly as in the archive (e.g. still PNG encoded)
+#
+#   stream = PackedStream("/data/oxford-radar-robotcar-dataset/2019-01-10-14-36-48-radar-oxford-10k/packed/radar")
+#   png = stream.frame_at(1547131046353776)  # Zero copy uint8 view into the shard
+
+_packed_dir_name = "packed"
+_stream_info_name = "stream.json"
+_index_name = "index.npy"
+_shard_name_format = "shard_{:05d}.bin"
+_alignment = 4096  # Frames start on page boundaries
+_default_shard_size = 1024 * 1024 * 1024
+
+index_dtype = np.dtype([('timestamp', '<i8'), ('shard', '<u4'), ('offset', '<u8'), ('length', '<u8')])
+
+PackStats = namedtuple('PackStats', ['stream', 'frames', 'missing', 'bytes', 'shards', 'seconds'])
+
+
+def read_timestamps(timestamps_path):
+    # Lines of `<UNIX timestamp in microseconds> <chunk>`
+    timestamps = []
+    with open(timestamps_path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 0:
+                timestamps.append(int(fields[0]))
+    return timestamps
+
+
+def _frame_files(frame_dir):
+    # Timestamp -> frame file name, for files named by their timestamp
+    frames = {}
+    for entry in os.scandir(frame_dir):
+        stem = os.path.splitext(entry.name)[0]
+        if entry.is_file() and stem.isdigit():
+            frames[int(stem)] = entry.name
+    return frames
+
+
+def find_streams(download_folder, timestamps_name):
+    # The streams of one `*.timestamps` member of an archive, a folder of frames next to it e.g. `radar` for
+    # `<dataset>/radar.timestamps`, or each camera of a folder e.g. `stereo/centre` for `<dataset>/stereo.timestamps`
+    # Returns a list of (dataset folder, stream, timestamps path)
+    timestamps_path = os.path.join(download_folder, *timestamps_name.split('/'))
+    dataset_dir = os.path.dirname(timestamps_path)
+    folder = os.path.splitext(timestamps_path)[0]
+    streams = []
+    if not os.path.isfile(timestamps_path) or not os.path.isdir(folder):
+        return streams
+    candidates = [folder] + sorted(entry.path for entry in os.scandir(folder) if entry.is_dir())
+    for frame_dir in candidates:
+        if any(entry.is_file() and os.path.splitext(entry.name)[0].isdigit() for entry in os.scandir(frame_dir)):
+            streams.append((dataset_dir, os.path.relpath(frame_dir, dataset_dir), timestamps_path))
+    return streams
+
+
+def packed_stream_dir(dataset_dir, stream):
+    return os.path.join(dataset_dir, _packed_dir_name, stream.replace(os.path.sep, "_"))
+
+
+def is_packed(dataset_dir, stream):
+    return os.path.isfile(os.path.join(packed_stream_dir(dataset_dir, stream), _stream_info_name))
+
+
+def pack_stream(dataset_dir, stream, timestamps_path, shard_size=_default_shard_size, remove_frames=False):
+    start_time = time.time()
+    frame_dir = os.path.join(dataset_dir, stream)
+    output_dir = packed_stream_dir(dataset_dir, stream)
+    # Written next to the output and renamed into place, so a stream is either fully packed or not at all
+    tmp_dir = f"{output_dir}.{os.getpid()}.tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    frames = _frame_files(frame_dir)
+    timestamps = read_timestamps(timestamps_path)
+    # Partial extractions (--member_glob / --timestamp_from/to) only have some of the frames
+    present = sorted(timestamp for timestamp in timestamps if timestamp in frames)
+    index = np.zeros(len(present), dtype=index_dtype)
+    shard, offset, num_bytes = 0, 0, 0
+    f = open(os.path.join(tmp_dir, _shard_name_format.format(shard)), 'wb')
+    try:
+        for i, timestamp in enumerate(present):
+            with open(os.path.join(frame_dir, frames[timestamp]), 'rb') as frame_file:
+                data = frame_file.read()
+            if offset > 0 and offset + len(data) > shard_size:
+                f.close()
+                shard, offset = shard + 1, 0
+                f = open(os.path.join(tmp_dir, _shard_name_format.format(shard)), 'wb')
+            f.write(data)
+            index[i] = (timestamp, shard, offset, len(data))
+            padding = -len(data) % _alignment
+            f.write(b"\0" * padding)
+            offset += len(data) + padding
+            num_bytes += len(data)
+    finally:
+        f.close()
+    np.save(os.path.join(tmp_dir, _index_name), index)
+
+    extensions = sorted(set(os.path.splitext(frames[timestamp])[1] for timestamp in present))
+    info = {'stream': stream, 'timestamps': os.path.basename(timestamps_path), 'frames': len(present),
+            'missing': len(timestamps) - len(present), 'bytes': num_bytes, 'shards': shard + 1,
+            'shard_size': shard_size, 'alignment': _alignment, 'extensions': extensions, 'packed_at': time.time()}
+    with open(os.path.join(tmp_dir, _stream_info_name), 'w') as f:
+        json.dump(info, f, indent=1)
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.replace(tmp_dir, output_dir)
+
+    if remove_frames:
+        for timestamp in present:
+            os.remove(os.path.join(frame_dir, frames[timestamp]))
+    return PackStats(stream, len(present), len(timestamps) - len(present), num_bytes, shard + 1,
+                     time.time() - start_time)
+
+
+def pack_streams(download_folder, timestamps_names, workers=1, shard_size=_default_shard_size, remove_frames=False,
+                 event_log=None):
+    # Packs the streams of the given `*.timestamps` archive members (see ExtractionStats.timestamps), so a run only
+    # packs what it unpacked itself and never a stream another run sharing the folder is still writing
+    # Streams are packed in parallel, each by one process, and streams packed by an earlier run are skipped
+    jobs = []
+    for timestamps_name in timestamps_names:
+        for dataset_dir, stream, timestamps_path in find_streams(download_folder, timestamps_name):
+            if not is_packed(dataset_dir, stream):
+                jobs.append((os.path.basename(dataset_dir), dataset_dir, stream, timestamps_path))
+    results = []
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=process_pool_context()) as executor:
+        futures = [(dataset, executor.submit(pack_stream, dataset_dir, stream, timestamps_path, shard_size,
+                                             remove_frames))
+                   for dataset, dataset_dir, stream, timestamps_path in jobs]
+        for dataset, future in futures:
+            stats = future.result()
+            print(f"Packed {dataset} {stats.stream}: {stats.frames} frames, {stats.bytes / 1024 ** 2:.1f} MB into "
+                  f"{stats.shards} shards in {stats.seconds:.1f} s"
+                  f"{f' ({stats.missing} frames not extracted)' if stats.missing > 0 else ''}")
+            if event_log is not None:
+                event_log.stage_event('pack', stats.seconds, num_bytes=stats.bytes,
+                                      stream=f"{dataset}/{stats.stream}", frames=stats.frames, shards=stats.shards)
+            results.append((dataset, stats))
+    return results
+
+
+class PackedStream:
+    # Read only access to a packed stream, frames are uint8 views into memory mapped shards
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _stream_info_name)) as f:
+            self.info = json.load(f)
+        self.index = np.load(os.path.join(path, _index_name), mmap_mode='r')
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def timestamps(self):
+        return self.index['timestamp']
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(os.path.join(self.path, _shard_name_format.format(shard)), dtype=np.uint8,
+                                            mode='r')
+        return self._shards[shard]
+
+    def frame(self, i):
+        timestamp, shard, offset, length = self.index[i]
+        return self._shard(int(shard))[int(offset):int(offset) + int(length)]
+
+    def frame_at(self, timestamp):
+        i = int(np.searchsorted(self.timestamps, timestamp))
+        if i >= len(self) or self.timestamps[i] != timestamp:
+            raise KeyError(f"No frame at timestamp {timestamp} in {self.path}")
+        return self.frame(i)
+
+    def __getitem__(self, i):
+        return self.frame(i)
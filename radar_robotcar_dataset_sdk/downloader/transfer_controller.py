@@ -0,0 +1,170 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from contextlib import contextmanager
+import subprocess
+import threading
+import datetime
+import random
+import heapq
+import time
+import re
+
+from radar_robotcar_dataset_sdk.downloader.download_item import download_item_filename
+
+# Keeps a long pull going through Google Drive rate limits, download quotas and network failures: failed transfers
+# are classified, concurrency is lowered and raised AIMD style and the failed files are retried later while the
+# rest of the selection carries on
+
+RATE_LIMIT = "rate_limit"
+QUOTA = "quota"
+TRANSIENT = "transient"
+AUTH = "auth"
+FATAL = "fatal"
+
+# Matched against the error and the tail of rclone's log, checked in this order
+_failure_patterns = [
+    (QUOTA, re.compile(r"downloadQuotaExceeded|dailyLimitExceeded|quotaExceeded|download quota", re.IGNORECASE)),
+    (RATE_LIMIT, re.compile(r"rateLimitExceeded|userRateLimitExceeded|Rate Limit Exceeded|Error 429|"
+                            r"Too Many Requests", re.IGNORECASE)),
+    (AUTH, re.compile(r"invalid_grant|unauthorized_client|Error 401|couldn't fetch token|oauth2: cannot fetch token|"
+                      r"insufficientPermissions|Invalid Credentials", re.IGNORECASE)),
+]
+
+
+def classify_rclone_failure(error):
+    text = str(error)
+    if isinstance(error, subprocess.CalledProcessError) and error.stderr is not None:
+        stderr = error.stderr.decode(errors='replace') if isinstance(error.stderr, bytes) else error.stderr
+        text += "\n" + stderr
+    for kind, pattern in _failure_patterns:
+        if pattern.search(text) is not None:
+            return kind
+    # rclone has already been through its own low level retries, anything else from it is worth another go later
+    # but failures outside rclone (e.g. a full disk) would just fail again
+    return TRANSIENT if isinstance(error, subprocess.CalledProcessError) else FATAL
+
+
+class TransferController:
+    def __init__(self, max_concurrency, min_concurrency=1, increase_every=4, max_attempts=5, backoff_base=10.,
+                 backoff_cap=900., quota_retry_seconds=3600., max_quota_retries=24, event_log=None):
+        if max_concurrency < min_concurrency:
+            raise ValueError(f"max_concurrency must be at least min_concurrency: {max_concurrency}")
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.increase_every = increase_every
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.quota_retry_seconds = quota_retry_seconds
+        self.max_quota_retries = max_quota_retries
+        self.event_log = event_log
+        self.limit = max_concurrency
+        self._active = 0
+        self._successes = 0
+        self._paused_until = 0.
+        self._condition = threading.Condition()
+        self._retries = []  # Heap of (retry time, sequence number, job)
+        self._sequence = 0
+        self._attempts = {}
+        self._rate_limit_attempts = {}
+        self._quota_attempts = {}
+
+    @contextmanager
+    def slot(self, stop):
+        # Waits for one of the `limit` transfer slots and for any rate limit pause to end
+        # Yields False without a slot once `stop` is set, the caller must then not start its transfer
+        with self._condition:
+            while not stop.is_set() and (self._active >= self.limit or time.time() < self._paused_until):
+                self._condition.wait(max(0.01, min(1., self._paused_until - time.time())))
+            if stop.is_set():
+                acquired = False
+            else:
+                acquired = True
+                self._active += 1
+        if not acquired:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def on_success(self):
+        # Additive increase: one more slot after every `increase_every` clean transfers
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.increase_every and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                print(f"Transfers succeeding, concurrency raised to {self.limit}")
+                self._condition.notify_all()
+
+    def _backoff(self, attempt):
+        # Exponential backoff with jitter so parallel workers do not retry in lock step
+        return min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1)) * (0.5 + random.random() / 2)
+
+    def retry_later(self, jobs, error):
+        # Returns False if the failure should end the run
+        kind = classify_rclone_failure(error)
+        if kind in (AUTH, FATAL):
+            return False
+        with self._condition:
+            now = time.time()
+            for job in jobs:
+                key = download_item_filename(job[1])
+                if kind == QUOTA:
+                    # Quotas reset over hours, the file is parked and the rest of the selection carries on
+                    attempt = self._quota_attempts[key] = self._quota_attempts.get(key, 0) + 1
+                    if attempt > self.max_quota_retries:
+                        return False
+                    delay = self.quota_retry_seconds
+                elif kind == RATE_LIMIT:
+                    # Rate limits always clear so they are retried without a limit
+                    attempt = self._rate_limit_attempts[key] = self._rate_limit_attempts.get(key, 0) + 1
+                    delay = self._backoff(attempt)
+                    self._paused_until = max(self._paused_until, now + delay)
+                else:
+                    attempt = self._attempts[key] = self._attempts.get(key, 0) + 1
+                    if attempt >= self.max_attempts:
+                        return False
+                    delay = self._backoff(attempt)
+                heapq.heappush(self._retries, (now + delay, self._sequence, job))
+                self._sequence += 1
+                retry_at = datetime.datetime.fromtimestamp(now + delay).strftime('%Y-%m-%d %H:%M:%S')
+                print(f"\n{kind.replace('_', ' ').capitalize()} failure for {key} (attempt {attempt}), "
+                      f"retrying at {retry_at}")
+                if self.event_log is not None:
+                    self.event_log.event('transfer_retry', kind=kind, dataset=job[1].dataset,
+                                         sensor=job[1].sensor, attempt=attempt, delay=delay, error=repr(error))
+            if kind == RATE_LIMIT:
+                # Multiplicative decrease, and every transfer waits out the backoff as the limit is per user
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                self._successes = 0
+                print(f"Rate limited, concurrency lowered to {self.limit}")
+            self._condition.notify_all()
+        return True
+
+    def next_retry(self, stop):
+        # Blocks until the earliest retry is due, returns None once there are none left or on stop
+        with self._condition:
+            while not stop.is_set() and len(self._retries) > 0:
+                wait = self._retries[0][0] - time.time()
+                if wait <= 0:
+                    return heapq.heappop(self._retries)[2]
+                self._condition.wait(min(wait, 1.))
+        return None
@@ -0,0 +1,159 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import zipfile
+import time
+import os
+
+from radar_robotcar_dataset_sdk.downloader.zip_stream_reader import StreamingZipReader
+
+_default_buffer_size = 16 * 1024 * 1024  # Per worker, so peak memory is roughly workers * buffer_size
+_timestamps_extension = ".timestamps"
+
+
+# `timestamps` are the names of the archive's `*.timestamps` members, which identify its sensor streams
+class ExtractionStats(namedtuple('ExtractionStats', ['members', 'bytes', 'seconds', 'timestamps'], defaults=((),))):
+    @property
+    def members_per_second(self):
+        return self.members / max(self.seconds, 1e-6)
+
+    @property
+    def MB_per_second(self):
+        return self.bytes / 1024 ** 2 / max(self.seconds, 1e-6)
+
+    def __str__(self):
+        return f"{self.members} members, {self.bytes / 1024 ** 2:.1f} MB in {self.seconds:.1f} s " \
+               f"({self.members_per_second:.0f} members/s, {self.MB_per_second:.1f} MB/s)"
+
+
+def process_pool_context():
+    # Pools are started from worker threads while downloads run, and forking a multi-threaded process can deadlock
+    start_methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in start_methods else "spawn")
+
+
+def timestamps_members(member_names):
+    return tuple(name for name in member_names if name.endswith(_timestamps_extension))
+
+
+def member_output_path(output_dir, member_name):
+    # Mirrors the sanitising in ZipFile._extract_member so members cannot be written outside output_dir
+    arcname = member_name.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    invalid_path_parts = ('', os.path.curdir, os.path.pardir)
+    arcname = os.path.sep.join(x for x in arcname.split(os.path.sep) if x not in invalid_path_parts)
+    return os.path.join(output_dir, arcname)
+
+
+def write_member(source, output_dir, member_name, is_dir, buffer_size=_default_buffer_size):
+    output_path = member_output_path(output_dir, member_name)
+    if is_dir:
+        os.makedirs(output_path, exist_ok=True)
+        return 0
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    written = 0
+    with open(output_path, 'wb') as f:
+        while True:
+            chunk = source.read(buffer_size)
+            if not chunk:
+                break
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def _extract_members(zip_path, output_dir, member_names, buffer_size):
+    # Each worker opens the archive itself as ZipFile objects cannot be shared between processes
+    num_bytes = 0
+    with zipfile.ZipFile(zip_path, allowZip64=True) as zip_file:
+        for member_name in member_names:
+            info = zip_file.getinfo(member_name)
+            if info.is_dir():
+                write_member(None, output_dir, member_name, True)
+            else:
+                with zip_file.open(info) as source:
+                    num_bytes += write_member(source, output_dir, member_name, False, buffer_size)
+    return len(member_names), num_bytes
+
+
+def _partition_members(infos, num_partitions):
+    # Contiguous runs of roughly equal uncompressed size keep each worker reading the archive sequentially
+    total_size = sum(info.file_size for info in infos)
+    target_size = total_size / num_partitions
+    partitions = [[]]
+    partition_size = 0
+    for info in infos:
+        if partition_size >= target_size and len(partitions) < num_partitions:
+            partitions.append([])
+            partition_size = 0
+        partitions[-1].append(info.filename)
+        partition_size += info.file_size
+    return partitions
+
+
+def verify_extraction(zip_path, output_dir):
+    # Cheap check that every member exists on disk with the right size, returns the names of any that do not
+    bad_members = []
+    with zipfile.ZipFile(zip_path, allowZip64=True) as zip_file:
+        for info in zip_file.infolist():
+            output_path = member_output_path(output_dir, info.filename)
+            if info.is_dir():
+                if not os.path.isdir(output_path):
+                    bad_members.append(info.filename)
+            elif not os.path.isfile(output_path) or os.path.getsize(output_path) != info.file_size:
+                bad_members.append(info.filename)
+    return bad_members
+
+
+def extract_zip(zip_path, output_dir, workers=1, buffer_size=_default_buffer_size):
+    if workers < 1:
+        raise ValueError(f"workers must be at least 1: {workers}")
+    start_time = time.time()
+    with zipfile.ZipFile(zip_path, allowZip64=True) as zip_file:
+        infos = zip_file.infolist()
+
+    if workers == 1 or len(infos) < 2:
+        num_members, num_bytes = _extract_members(zip_path, output_dir, [info.filename for info in infos],
+                                                  buffer_size)
+    else:
+        partitions = _partition_members(infos, workers)
+        num_members, num_bytes = 0, 0
+        with ProcessPoolExecutor(max_workers=len(partitions), mp_context=process_pool_context()) as executor:
+            futures = [executor.submit(_extract_members, zip_path, output_dir, partition, buffer_size)
+                       for partition in partitions]
+            for future in futures:
+                partition_members, partition_bytes = future.result()
+                num_members += partition_members
+                num_bytes += partition_bytes
+
+    return ExtractionStats(num_members, num_bytes, time.time() - start_time,
+                           timestamps_members(info.filename for info in infos))
+
+
+def extract_zip_stream(stream, output_dir, buffer_size=_default_buffer_size):
+    # Members are written straight to their final paths as they arrive so the archive never touches the disk
+    start_time = time.time()
+    num_members, num_bytes = 0, 0
+    member_names = []
+    for member in StreamingZipReader(stream):
+        num_bytes += write_member(member, output_dir, member.filename, member.is_dir(), buffer_size)
+        num_members += 1
+        member_names.append(member.filename)
+    return ExtractionStats(num_members, num_bytes, time.time() - start_time, timestamps_members(member_names))
@@ -0,0 +1,201 @@
+################################################################################
+#
+# Copyright (c) 2019 University of Oxford
+# Authors:
+#  Dan Barnes (dbarnes@robots.ox.ac.uk)
+#
+# This work is licensed under the Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc-sa/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+#
+###############################################################################
+
+from __future__ import division, print_function, absolute_import
+import zipfile
+import struct
+import zlib
+
+# Reads zip members front to back from a non-seekable stream (e.g. `rclone cat` stdout) using the local file headers
+# rather than the central directory at the end of the archive
+
+_local_file_header_signature = b"PK\x03\x04"
+_data_descriptor_signature = b"PK\x07\x08"
+_end_of_entries_signatures = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x07")
+_local_file_header_struct = struct.Struct("<HHHHHIIIHH")
+_zip64_extra_id = 0x0001
+_zip64_limit = 0xFFFFFFFF
+_flag_encrypted = 0x1
+_flag_data_descriptor = 0x8
+_flag_utf8 = 0x800
+_read_size = 1024 * 1024
+
+
+class _PushbackStream:
+    def __init__(self, raw):
+        self._raw = raw
+        self._buffer = b""
+
+    def read(self, n):
+        if len(self._buffer) > 0:
+            data, self._buffer = self._buffer[:n], self._buffer[n:]
+            return data
+        return self._raw.read(n)
+
+    def read_exact(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.read(n - len(data))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Truncated zip stream: expected {n} bytes but got {len(data)}")
+            data += chunk
+        return data
+
+    def unread(self, data):
+        self._buffer = data + self._buffer
+
+    def drain(self):
+        while self.read(_read_size):
+            pass
+
+
+class StreamMember:
+    def __init__(self, stream, filename, flags, compress_type, crc, compress_size, file_size, zip64):
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise zipfile.BadZipFile(f"Compression method {compress_type} not supported for streamed member: "
+                                   f"{filename}")
+        self.filename = filename
+        self.compress_type = compress_type
+        self._stream = stream
+        self._has_data_descriptor = flags & _flag_data_descriptor != 0
+        if self._has_data_descriptor and compress_type == zipfile.ZIP_STORED:
+            # Without a size the end of stored data cannot be found without the central directory
+            raise zipfile.BadZipFile(f"Stored member with a data descriptor cannot be streamed: {filename}")
+        self._crc = crc
+        self._remaining = None if self._has_data_descriptor else compress_size
+        self._file_size = file_size
+        self._zip64 = zip64
+        self._decompressor = zlib.decompressobj(-15) if compress_type == zipfile.ZIP_DEFLATED else None
+        self._pending = b""
+        self._running_crc = 0
+        self._read_bytes = 0
+        self._eof = False
+
+    def is_dir(self):
+        return self.filename.endswith('/')
+
+    def read(self, n=-1):
+        if n < 0:
+            chunks = [self._pending]
+            while not self._eof:
+                self._pending = b""
+                self._fill()
+                chunks.append(self._pending)
+            self._pending = b""
+            return b"".join(chunks)
+        # Short reads like a raw file, at most one chunk is decoded per call rather than re-copying a growing buffer
+        while len(self._pending) == 0 and not self._eof:
+            self._fill()
+        data, self._pending = self._pending[:n], self._pending[n:]
+        return data
+
+    def drain(self):
+        while not self._eof:
+            self._fill()
+            self._pending = b""
+        self._pending = b""
+
+    def _fill(self):
+        if self._decompressor is None:
+            if self._remaining == 0:
+                self._finish()
+                return
+            data = self._stream.read(min(self._remaining, _read_size))
+            if not data:
+                raise zipfile.BadZipFile(f"Truncated zip stream in member: {self.filename}")
+            self._remaining -= len(data)
+        else:
+            if len(self._decompressor.unconsumed_tail) > 0:
+                raw = self._decompressor.unconsumed_tail
+            elif self._remaining is None:
+                raw = self._stream.read(_read_size)
+            else:
+                raw = self._stream.read(min(self._remaining, _read_size)) if self._remaining > 0 else b""
+                self._remaining -= len(raw)
+            if not raw and not self._decompressor.eof:
+                raise zipfile.BadZipFile(f"Truncated zip stream in member: {self.filename}")
+            # Bounding the output keeps memory flat even for highly compressible members
+            data = self._decompressor.decompress(raw, _read_size)
+        self._running_crc = zlib.crc32(data, self._running_crc)
+        self._read_bytes += len(data)
+        self._pending += data
+        if self._decompressor is not None and self._decompressor.eof:
+            # Anything read past the end of the deflate stream belongs to the next header
+            self._stream.unread(self._decompressor.unused_data)
+            self._finish()
+
+    def _finish(self):
+        self._eof = True
+        if self._has_data_descriptor:
+            signature_or_crc = self._stream.read_exact(4)
+            if signature_or_crc == _data_descriptor_signature:
+                signature_or_crc = self._stream.read_exact(4)
+            self._crc = struct.unpack("<I", signature_or_crc)[0]
+            size_format = "<QQ" if self._zip64 else "<II"
+            _, self._file_size = struct.unpack(size_format, self._stream.read_exact(struct.calcsize(size_format)))
+        if self._read_bytes != self._file_size:
+            raise zipfile.BadZipFile(f"Bad size for member {self.filename}: expected {self._file_size} bytes but "
+                                     f"read {self._read_bytes}")
+        if self._running_crc != self._crc:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for member: {self.filename}")
+
+
+class StreamingZipReader:
+    def __init__(self, raw):
+        self._stream = _PushbackStream(raw)
+        self._member = None
+
+    def __iter__(self):
+        first = True
+        while True:
+            if self._member is not None:
+                self._member.drain()
+                self._member = None
+            signature = self._stream.read(4)
+            if first and not signature:
+                raise zipfile.BadZipFile("Empty zip stream")
+            first = False
+            if len(signature) < 4:
+                signature += self._stream.read_exact(4 - len(signature))
+            if signature in _end_of_entries_signatures:
+                # Central directory reached, nothing left to extract
+                self._stream.drain()
+                return
+            if signature != _local_file_header_signature:
+                raise zipfile.BadZipFile(f"Bad local file header signature: {signature!r}")
+            self._member = self._read_member()
+            yield self._member
+
+    def _read_member(self):
+        (_, flags, compress_type, _, _, crc, compress_size, file_size, filename_length,
+         extra_length) = _local_file_header_struct.unpack(self._stream.read_exact(_local_file_header_struct.size))
+        filename = self._stream.read_exact(filename_length)
+        extra = self._stream.read_exact(extra_length)
+        filename = filename.decode('utf-8' if flags & _flag_utf8 else 'cp437')
+        if flags & _flag_encrypted:
+            raise zipfile.BadZipFile(f"Encrypted members are not supported: {filename}")
+
+        zip64 = False
+        while len(extra) >= 4:
+            extra_id, extra_size = struct.unpack("<HH", extra[:4])
+            if extra_id == _zip64_extra_id:
+                zip64 = True
+                values = extra[4:4 + extra_size]
+                if file_size == _zip64_limit:
+                    file_size, values = struct.unpack("<Q", values[:8])[0], values[8:]
+                if compress_size == _zip64_limit:
+                    compress_size = struct.unpack("<Q", values[:8])[0]
+            extra = extra[4 + extra_size:]
+
+        return StreamMember(self._stream, filename, flags, compress_type, crc, compress_size, file_size, zip64)
@@ -29,6 +29,8 @@ setup(name='radar-robotcar-dataset-sdk',
       license='Attribution-NonCommercial-ShareAlike 4.0 International',
       packages=find_namespace_packages(include=['radar_robotcar_dataset_sdk*']),
       install_requires=required,
+      # Only needed to pack frames into shards with --pack_shards
+      extras_require={'pack': ['numpy']},
       project_urls={
           'Oxford Radar RobotCar Dataset': 'https://ori.ox.ac.uk/datasets/radar-robotcar-dataset',
           'Oxford Radar RobotCar Dataset SDK Source': 'http://github.com/dbarnes/radar-robotcar-dataset-sdk',